@@ -0,0 +1,548 @@
+import os
+import sys
+import json
+import random
+import shutil
+import asyncio
+import argparse
+import contextlib
+import subprocess
+import time
+import timeit
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:  # Windows: không đo được RSS
+    resource = None
+
+import CheckInvalidFile as bot
+
+# ===================================
+# === CẤU HÌNH BENCHMARK ============
+# ===================================
+
+WORKSPACE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SEED = 2024
+DEFAULT_WORKDIR = os.path.join(WORKSPACE, "bench_workspace")
+DEFAULT_BASELINE = os.path.join(WORKSPACE, "bench_baseline.json")
+# Kết quả chậm hơn baseline quá tỉ lệ này bị coi là regression
+DEFAULT_TOLERANCE = 0.2
+BENCH_CHAT_ID = 1
+
+# ===================================
+# === BENCHMARK LUẬT TỈNH ===========
+# ===================================
+
+def load_legacy_rules(json_path):
+    """Cách nạp luật cũ: dict mã tỉnh -> mã đơn vị (khai báo trùng sẽ bị ghi đè)."""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        province_data = json.load(f)
+    rules = {}
+    for entry in province_data:
+        ma_tinh = entry["ma_tinh"].strip().lower()
+        if ma_tinh:
+            rules[ma_tinh] = [s.lower() for s in entry["duoi_file"]]
+    return rules
+
+def legacy_match(rules, commit_msg, file):
+    """Vòng lặp lồng nhau cũ trong validate_file, giữ lại để so sánh."""
+    matched = False
+    ma_tinh_match = None
+    for ma_tinh, duoi_files in rules.items():
+        if ma_tinh in commit_msg:
+            ma_tinh_match = ma_tinh
+            if any(duoi in file.lower() for duoi in duoi_files):
+                matched = True
+                break
+    return ma_tinh_match, matched
+
+def generate_rule_samples(rules, count, files_per_commit=1, seed=DEFAULT_SEED):
+    """
+    Sinh các cặp (commit message, đường dẫn file) giống dữ liệu thật:
+    mỗi commit chạm `files_per_commit` file.
+    """
+    rnd = random.Random(seed)
+    codes = list(rules)
+    samples = []
+    for i in range(count):
+        if i % files_per_commit == 0:
+            ma_tinh = rnd.choice(codes)
+            roll = rnd.random()
+            if roll < 0.1:
+                msg = f"fix loi bao cao thang {i % 12 + 1}"
+            elif roll < 0.2:
+                msg = f"{ma_tinh} {rnd.choice(codes)} cap nhat ham tinh tien"
+            else:
+                msg = f"{ma_tinh} - sua loi in phieu it360-{1500000 + i}"
+        unit = rnd.choice(rules[ma_tinh]) if rnd.random() < 0.8 else "xyz"
+        file = f"20240101_17H19/{ma_tinh.upper()}/PKG_BAOCAO_{unit.upper()}_{i}.sql"
+        samples.append((msg, file))
+    return samples
+
+def bench_rules(json_path, count, repeat, files_per_commit=1, seed=DEFAULT_SEED):
+    legacy_rules = load_legacy_rules(json_path)
+    samples = generate_rule_samples(legacy_rules, count, files_per_commit, seed)
+    # Mỗi lần đo dùng một matcher mới để cache commit message không "ấm" sẵn
+    matchers = [bot.load_province_rules(json_path) for _ in range(repeat + 1)]
+
+    def run_legacy():
+        for msg, file in samples:
+            legacy_match(legacy_rules, msg, file)
+
+    def run_matcher():
+        matcher = matchers.pop()
+        for msg, file in samples:
+            matcher.match(msg, file)
+
+    legacy_time = min(timeit.repeat(run_legacy, number=1, repeat=repeat))
+    matcher_time = min(timeit.repeat(run_matcher, number=1, repeat=repeat))
+    matcher = matchers.pop()
+    differences = sum(
+        1 for msg, file in samples if legacy_match(legacy_rules, msg, file) != matcher.match(msg, file)
+    )
+    return {
+        "samples": count,
+        "files_per_commit": files_per_commit,
+        "legacy_us_per_file": legacy_time / count * 1e6,
+        "matcher_us_per_file": matcher_time / count * 1e6,
+        "speedup": legacy_time / matcher_time if matcher_time else None,
+        "different_results": differences,
+    }
+
+# ===================================
+# === TẠO REPO GIẢ LẬP ==============
+# ===================================
+
+def _province_weights(codes, zipf, rnd):
+    """Trọng số chọn mã tỉnh: 0 = đều nhau, >0 = phân bố Zipf (vài tỉnh chiếm phần lớn commit)."""
+    order = list(codes)
+    rnd.shuffle(order)
+    if zipf <= 0:
+        return order, [1.0] * len(order)
+    return order, [1.0 / (rank + 1) ** zipf for rank in range(len(order))]
+
+def _sql_content(rnd, size, invalid):
+    """Sinh nội dung SQL ~`size` byte; file không hợp lệ chứa từ khóa cấm hoặc thiếu dấu '/' cuối."""
+    lines = [f"CREATE OR REPLACE PACKAGE BODY PKG_{rnd.randint(1, 99999)} AS"]
+    length = len(lines[0])
+    while length < size:
+        roll = rnd.random()
+        if roll < 0.2:
+            line = f"  -- update ghi chu {rnd.randint(1, 10**6)}"
+        elif roll < 0.3:
+            line = f"  v_msg := 'khong delete du lieu {rnd.randint(1, 10**6)}';"
+        else:
+            line = f"  SELECT col_{rnd.randint(1, 50)}, updated_at INTO v_{rnd.randint(1, 9)} FROM tbl_{rnd.randint(1, 30)} WHERE id = {rnd.randint(1, 10**6)};"
+        lines.append(line)
+        length += len(line) + 1
+    kind = rnd.choice(["keyword", "terminator"]) if invalid else None
+    if kind == "keyword":
+        lines.insert(rnd.randint(1, len(lines)), "  UPDATE tbl_1 SET a = 1;")
+    lines.append("END;")
+    if kind != "terminator":
+        lines.append("/")
+    return "\n".join(lines) + "\n"
+
+def generate_repo(workdir, json_path, folders=3, today_folders=2, files_per_folder=200, sql_kb=8,
+                  commits=60, zipf=1.0, invalid_ratio=0.1, jrxml_ratio=0.05, seed=DEFAULT_SEED):
+    """
+    Tạo repo giống `outsource.git` trong `workdir`: bare repo nguồn `source.git` (branch SOURCE_REPO_BRANCH)
+    và bare repo deploy `deploy.git`. `folders` thư mục ngày (trong đó `today_folders` thư mục của hôm nay),
+    mỗi thư mục `files_per_folder` file, lịch sử `commits` commit (mỗi commit thuộc một tỉnh, một phần
+    là commit sửa lại file đã có; mỗi thư mục có một merge giải conflict trên một file, ghi vào "merged_files").
+    Dùng `git fast-import` nên nhanh và lặp lại được với cùng `seed`.
+    Trả về dict mô tả repo đã tạo.
+    """
+    rnd = random.Random(seed)
+    rules = load_legacy_rules(json_path)
+    codes, weights = _province_weights(sorted(rules), zipf, rnd)
+
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    source = os.path.join(workdir, "source.git")
+    deploy = os.path.join(workdir, "deploy.git")
+    for path, branch in ((source, bot.SOURCE_REPO_BRANCH), (deploy, bot.DEPLOY_REPO_BRANCH)):
+        subprocess.run(["git", "init", "-q", "--bare", path], check=True)
+        subprocess.run(["git", "-C", path, "symbolic-ref", "HEAD", f"refs/heads/{branch}"], check=True)
+        subprocess.run(["git", "-C", path, "config", "uploadpack.allowFilter", "true"], check=True)
+
+    now = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+    today_str = now.strftime("%Y%m%d")
+    names = [today_str] + [f"{today_str}_{17 + i // 6:02d}H{(i % 6) * 10 + 9:02d}" for i in range(today_folders - 1)]
+    names += [(now - timedelta(days=day + 1)).strftime("%Y%m%d") for day in range(folders - len(names))]
+    names.sort()
+
+    stream = []
+    mark = 0
+    heads = {}
+    counts = {"commits": 0, "files": 0, "bytes": 0, "invalid": 0}
+    merged_files = []
+    commits_per_folder = max(1, commits // len(names))
+    side_branch = "bench-side"
+
+    def add_commit(branch, message, when, changes, parent=None, merge=None):
+        nonlocal mark
+        mark += 1
+        data = message.encode("utf-8")
+        timestamp = int(when.timestamp())
+        stream.append(f"commit refs/heads/{branch}\nmark :{mark}\n".encode())
+        stream.append(f"author Dev {when.hour} <dev@example.com> {timestamp} +0700\n".encode())
+        stream.append(f"committer Dev {when.hour} <dev@example.com> {timestamp} +0700\n".encode())
+        stream.append(f"data {len(data)}\n".encode() + data + b"\n")
+        parent = parent or heads.get(branch)
+        if parent:
+            stream.append(f"from :{parent}\n".encode())
+        if merge:
+            stream.append(f"merge :{merge}\n".encode())
+        for path, content in changes:
+            blob = content.encode("utf-8")
+            stream.append(f"M 100644 inline {path}\ndata {len(blob)}\n".encode() + blob + b"\n")
+        stream.append(b"\n")
+        heads[branch] = mark
+        counts["commits"] += 1
+        return mark
+
+    for folder in names:
+        day = datetime.strptime(folder[:8], "%Y%m%d").replace(hour=8)
+        created = []
+        file_no = 0
+        for c in range(commits_per_folder):
+            ma_tinh = rnd.choices(codes, weights)[0]
+            when = day + timedelta(minutes=c * (600 // commits_per_folder))
+            changes = []
+            if created and rnd.random() < 0.2:
+                # Commit sửa lại vài file đã có: lookup commit phải lấy commit MỚI NHẤT
+                for path in rnd.sample(created, min(3, len(created))):
+                    invalid = rnd.random() < invalid_ratio
+                    changes.append((path, _sql_content(rnd, sql_kb * 1024, invalid)))
+            else:
+                remaining = files_per_folder - file_no
+                batch = remaining // (commits_per_folder - c) if c < commits_per_folder - 1 else remaining
+                for _ in range(batch):
+                    unit = rnd.choice(rules[ma_tinh]) if rnd.random() > invalid_ratio / 2 else "xyz"
+                    if rnd.random() < jrxml_ratio:
+                        path = f"{folder}/{ma_tinh.upper()}/RPT_{unit.upper()}_{file_no}.jrxml"
+                        content = "<jasperReport/>\n"
+                    else:
+                        path = f"{folder}/{ma_tinh.upper()}/PKG_{unit.upper()}_{file_no}.sql"
+                        invalid = rnd.random() < invalid_ratio
+                        counts["invalid"] += invalid
+                        content = _sql_content(rnd, sql_kb * 1024, invalid)
+                        created.append(path)
+                    changes.append((path, content))
+                    counts["files"] += 1
+                    counts["bytes"] += len(content)
+                    file_no += 1
+            if changes:
+                add_commit(bot.SOURCE_REPO_BRANCH, f"{ma_tinh} - sua loi it360-{rnd.randint(1500000, 1599999)}", when, changes)
+
+        if created:
+            # Hai nhánh cùng sửa một file, merge giải conflict bằng nội dung mới: commit gần nhất của file
+            # là commit merge (tỉnh của merge), không phải commit bên nhánh phụ
+            path = rnd.choice(created)
+            when = day + timedelta(hours=11)
+            base = heads[bot.SOURCE_REPO_BRANCH]
+            side_code, main_code, merge_code = (rnd.choices(codes, weights)[0] for _ in range(3))
+            side = add_commit(side_branch, f"{side_code} - sua tren nhanh phu", when,
+                              [(path, _sql_content(rnd, sql_kb * 1024, False))], parent=base)
+            add_commit(bot.SOURCE_REPO_BRANCH, f"{main_code} - sua tren nhanh chinh", when + timedelta(minutes=1),
+                       [(path, _sql_content(rnd, sql_kb * 1024, False))])
+            add_commit(bot.SOURCE_REPO_BRANCH, f"Merge nhanh phu, giai conflict {merge_code}", when + timedelta(minutes=2),
+                       [(path, _sql_content(rnd, sql_kb * 1024, False))], merge=side)
+            merged_files.append(path)
+
+    subprocess.run(["git", "-C", source, "fast-import", "--quiet"], input=b"".join(stream), check=True)
+    subprocess.run(["git", "-C", source, "update-ref", "-d", f"refs/heads/{side_branch}"], check=True)
+    mark = 0
+    heads.clear()
+    stream = []
+    add_commit(bot.DEPLOY_REPO_BRANCH, "init", now, [("README", "deploy\n")])
+    subprocess.run(["git", "-C", deploy, "fast-import", "--quiet"], input=b"".join(stream), check=True)
+    counts["commits"] -= 1
+    return {"source": source, "deploy": deploy, "folders": names, "today": today_str,
+            "merged_files": merged_files, **counts}
+
+# ===================================
+# === BENCHMARK PIPELINE ============
+# ===================================
+
+class StubBot:
+    """Bot Telegram giả: ghi lại tin nhắn thay vì gửi đi."""
+
+    def __init__(self):
+        self.messages = []
+        self._next_id = 0
+
+    def _message(self, chat_id):
+        self._next_id += 1
+        return SimpleNamespace(chat_id=chat_id, message_id=self._next_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages.append(("send", chat_id, text))
+        return self._message(chat_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.messages.append(("edit", chat_id, text))
+        return True
+
+    async def send_document(self, chat_id, document, filename=None, caption=None, **kwargs):
+        self.messages.append(("document", chat_id, filename))
+        return self._message(chat_id)
+
+async def run_command(handler, stub, args):
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=BENCH_CHAT_ID), effective_user=None, message=None)
+    context = SimpleNamespace(bot=stub, args=list(args), application=None, bot_data={})
+    started = time.perf_counter()
+    await handler(update, context)
+    return time.perf_counter() - started
+
+def _peak_rss_mb(who):
+    if resource is None:
+        return None
+    # ru_maxrss tính bằng KB trên Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+def _configure_bot(workdir, repo_info, json_path):
+    """Trỏ các đường dẫn của bot vào workspace benchmark (không đụng tới repo thật)."""
+    bot.WORKSPACE = workdir
+    bot.SOURCE_REPO_URL = "file://" + repo_info["source"]
+    bot.DEPLOY_REPO_URL = "file://" + repo_info["deploy"]
+    bot.REPO_PATH = os.path.join(workdir, "outsource")
+    bot.DEST_PATH = os.path.join(workdir, "outsource_cleaned")
+    bot.DEPLOY_REPO = os.path.join(workdir, "deploy")
+    bot.JSON_PATH = json_path
+    bot.VALIDATION_CACHE_PATH = os.path.join(workdir, "validation_cache.json")
+    bot.METRICS = bot.StageMetrics(os.path.join(workdir, "metrics.jsonl"), prom_path="")
+    bot._validation_cache = None
+    # Bot giả không bị Telegram giới hạn tốc độ: bỏ giới hạn của Outbox để chỉ đo pipeline
+    bot.OUTBOX_CHAT_RATE = bot.OUTBOX_GROUP_RATE = bot.OUTBOX_GLOBAL_RATE = 1e6
+    bot.OUTBOX_CHAT_BURST = 1e6
+
+def _reset_validation_cache():
+    bot._validation_cache = None
+    if os.path.exists(bot.VALIDATION_CACHE_PATH):
+        os.remove(bot.VALIDATION_CACHE_PATH)
+
+def _check_merge_commits(repo_info):
+    """File sửa lại khi giải conflict phải được gán cho commit merge, giống `git log -1 -- <file>`."""
+    merged = repo_info["merged_files"]
+    index = bot.build_commit_index(bot.REPO_PATH, sorted({path.split("/", 1)[0] for path in merged}), wanted=merged)
+    for path in merged:
+        expected = subprocess.run(
+            ["git", "-C", bot.REPO_PATH, "log", "-1", "--format=%H", "--", path],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True,
+        ).stdout.strip()
+        found = index[path].sha if path in index else None
+        if found != expected:
+            raise RuntimeError(f"Commit index sai cho `{path}`: {found} thay vì commit merge {expected}")
+
+async def _drive_pipeline(repo_info):
+    stub = StubBot()
+    timings = {}
+    prepare_started = time.perf_counter()
+    for path, url, branch in ((bot.REPO_PATH, bot.SOURCE_REPO_URL, bot.SOURCE_REPO_BRANCH),
+                              (bot.DEPLOY_REPO, bot.DEPLOY_REPO_URL, bot.DEPLOY_REPO_BRANCH)):
+        if not bot.prepare_repo(path, url, branch):
+            raise RuntimeError(f"Không chuẩn bị được repo {path}")
+    timings["clone_seconds"] = time.perf_counter() - prepare_started
+
+    bot.warm_validation_pool()
+    today = repo_info["today"]
+    today_files = int(subprocess.run(
+        ["git", "-C", bot.REPO_PATH, "ls-files", "--", f"{today}/"], stdout=subprocess.PIPE, check=True,
+    ).stdout.count(b"\n"))
+
+    _check_merge_commits(repo_info)
+
+    _reset_validation_cache()
+    timings["check_cold_seconds"] = await run_command(bot.checkinvalidfile_command, stub, [])
+    timings["check_warm_seconds"] = await run_command(bot.checkinvalidfile_command, stub, [])
+    _reset_validation_cache()
+    first_upcode = len(stub.messages)
+    timings["upcode_seconds"] = await run_command(bot.upcode_command, stub, ["0", "17H19", "benchmark deploy"])
+    upcode_messages = stub.messages[first_upcode:]
+    timings["upcode_unchanged_seconds"] = await run_command(bot.upcode_command, stub, ["0", "17H19", "benchmark deploy"])
+
+    # Pipeline hỏng thì không được đo (và không được lưu làm baseline): mọi tin "❌" đều là lỗi,
+    # trừ các dòng report file không hợp lệ, và mọi job phải kết thúc ở trạng thái "done"
+    failures = [
+        text for kind, _, text in stub.messages
+        if kind != "document" and text.startswith("❌") and not text.startswith("❌ File không hợp lệ")
+    ]
+    failures += [
+        f"Job #{job.id} ({job.description}): {job.status}"
+        for job in bot.get_job_manager().jobs.values() if job.status != "done"
+    ]
+    if not any(kind != "document" and text.startswith("🎉") for kind, _, text in upcode_messages):
+        failures.append("/upcode đầu tiên không kết thúc bằng thông báo deploy thành công")
+    if failures:
+        raise RuntimeError("Pipeline lỗi: " + failures[0])
+    timings["check_cold_files_per_s"] = today_files / timings["check_cold_seconds"]
+    timings["check_warm_files_per_s"] = today_files / timings["check_warm_seconds"]
+    timings["upcode_files_per_s"] = today_files / timings["upcode_seconds"]
+    return today_files, len(stub.messages), timings
+
+def _stop_bot_children():
+    """
+    Dừng process pool validate và các `git cat-file` của bot: RUSAGE_CHILDREN chỉ tính tiến trình con
+    đã thoát, nên phải dừng chúng trước khi đo thì children_peak_rss_mb mới gồm cả các worker.
+    """
+    pool = bot._validation_pool
+    bot._validation_pool = None
+    if pool is not None:
+        pool.shutdown(wait=True)
+    bot._close_blob_readers()
+
+def bench_pipeline(workdir, json_path, generate_args, serial=False):
+    """Tạo repo giả lập, chạy lệnh kiểm tra và upcode với bot giả, trả về thời gian, throughput và bộ nhớ."""
+    generate_started = time.perf_counter()
+    repo_info = generate_repo(os.path.join(workdir, "remote"), json_path, **generate_args)
+    generate_seconds = time.perf_counter() - generate_started
+    _configure_bot(workdir, repo_info, json_path)
+    for name in ("outsource", "outsource_cleaned", "deploy"):
+        shutil.rmtree(os.path.join(workdir, name), ignore_errors=True)
+    bot.VALIDATION_SERIAL = serial
+
+    # Log tiến trình của bot ra stderr để stdout chỉ còn kết quả JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        today_files, messages, timings = asyncio.run(_drive_pipeline(repo_info))
+    _stop_bot_children()
+    stages = {
+        stage: {"p50_seconds": p50, "p95_seconds": p95, "count": total}
+        for stage, (_, p50, p95, total) in bot.METRICS.summary().items()
+    }
+    result = {
+        "scenario": dict(generate_args, serial=serial),
+        "repo": {key: repo_info[key] for key in ("commits", "files", "bytes", "invalid")},
+        "today_files": today_files,
+        "messages": messages,
+        "generate_seconds": generate_seconds,
+        "peak_rss_mb": _peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+        "children_peak_rss_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+        "stages": stages,
+    }
+    result.update(timings)
+    return result
+
+# ===================================
+# === BASELINE & REGRESSION =========
+# ===================================
+
+def _comparable_metrics(result):
+    """
+    Các chỉ số tổng hợp so sánh được: *_seconds, *_us_per_file, *_mb (càng nhỏ càng tốt) và *_per_s
+    (càng lớn càng tốt). Số đo theo stage chỉ để tra nguyên nhân, không so vì quá nhiễu.
+    """
+    metrics = {}
+    for key, value in result.items():
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        if key.endswith(("_seconds", "_us_per_file", "_mb")):
+            metrics[key] = (value, False)
+        elif key.endswith("_per_s"):
+            metrics[key] = (value, True)
+    return metrics
+
+def compare_baseline(name, result, baseline_path, tolerance=DEFAULT_TOLERANCE, save=False):
+    """
+    So sánh `result` với baseline `name` trong file JSON; ghi đè baseline nếu `save`.
+    Trả về danh sách regression (rỗng nếu không có hoặc chưa có baseline để so).
+    """
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baselines = json.load(f)
+    regressions = []
+    baseline = baselines.get(name)
+    if baseline is None:
+        print(f"ℹ️ Chưa có baseline '{name}' trong {baseline_path}.")
+    elif baseline.get("scenario") != result.get("scenario"):
+        print(f"⚠️ Kịch bản khác baseline '{name}' (tham số khác nhau), bỏ qua so sánh.")
+    else:
+        current = _comparable_metrics(result)
+        for metric, (old_value, higher_is_better) in _comparable_metrics(baseline).items():
+            if metric not in current or not old_value:
+                continue
+            new_value = current[metric][0]
+            change = (new_value - old_value) / old_value
+            worse = -change if higher_is_better else change
+            if worse > tolerance:
+                regressions.append(f"{metric}: {old_value:.4g} -> {new_value:.4g} ({change:+.0%})")
+    if save:
+        baselines[name] = result
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, indent=2, ensure_ascii=False)
+        print(f"💾 Đã lưu baseline '{name}' vào {baseline_path}.")
+    return regressions
+
+# ===================================
+# === MAIN EXECUTION ================
+# ===================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cho bot kiểm tra file.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_rules = sub.add_parser("rules", help="So sánh ProvinceMatcher với vòng lặp cũ")
+    p_rules.add_argument("--json", default=os.path.join(WORKSPACE, "ProvinceRules.json"))
+    p_rules.add_argument("--samples", type=int, default=20000)
+    p_rules.add_argument("--repeat", type=int, default=5)
+    p_rules.add_argument("--files-per-commit", type=int, default=10)
+    p_rules.add_argument("--seed", type=int, default=DEFAULT_SEED)
+
+    def add_repo_args(p):
+        p.add_argument("--json", default=os.path.join(WORKSPACE, "ProvinceRules.json"))
+        p.add_argument("--workdir", default=DEFAULT_WORKDIR)
+        p.add_argument("--folders", type=int, default=3, help="Số thư mục ngày")
+        p.add_argument("--today-folders", type=int, default=2, help="Số thư mục của hôm nay trong đó")
+        p.add_argument("--files-per-folder", type=int, default=200)
+        p.add_argument("--sql-kb", type=int, default=8, help="Kích thước gần đúng mỗi file SQL (KB)")
+        p.add_argument("--commits", type=int, default=60)
+        p.add_argument("--zipf", type=float, default=1.0, help="Độ lệch phân bố mã tỉnh (0 = đều)")
+        p.add_argument("--invalid-ratio", type=float, default=0.1)
+        p.add_argument("--seed", type=int, default=DEFAULT_SEED)
+
+    def add_baseline_args(p):
+        p.add_argument("--baseline", default=DEFAULT_BASELINE)
+        p.add_argument("--save-baseline", action="store_true", help="Ghi kết quả lần này làm baseline")
+        p.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+
+    add_baseline_args(p_rules)
+
+    p_generate = sub.add_parser("generate", help="Chỉ tạo repo giả lập (bare) để thử bot bằng tay")
+    add_repo_args(p_generate)
+
+    p_pipeline = sub.add_parser("pipeline", help="Chạy /checkinvalidfile và /upcode trên repo giả lập")
+    add_repo_args(p_pipeline)
+    add_baseline_args(p_pipeline)
+    p_pipeline.add_argument("--serial", action="store_true", help="Validate tuần tự (không dùng process pool)")
+
+    args = parser.parse_args()
+    if args.command == "rules":
+        result = bench_rules(args.json, args.samples, args.repeat, args.files_per_commit, args.seed)
+        result["scenario"] = {"samples": args.samples, "files_per_commit": args.files_per_commit, "seed": args.seed}
+    else:
+        generate_args = {
+            "folders": args.folders, "today_folders": args.today_folders, "files_per_folder": args.files_per_folder,
+            "sql_kb": args.sql_kb, "commits": args.commits, "zipf": args.zipf,
+            "invalid_ratio": args.invalid_ratio, "seed": args.seed,
+        }
+        if args.command == "generate":
+            info = generate_repo(args.workdir, args.json, **generate_args)
+            print(json.dumps(info, indent=2, ensure_ascii=False))
+            return
+        result = bench_pipeline(args.workdir, args.json, generate_args, args.serial)
+
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    regressions = compare_baseline(args.command, result, args.baseline, args.tolerance, args.save_baseline)
+    if regressions:
+        print("❌ Regression so với baseline:")
+        for line in regressions:
+            print("   " + line)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,32 @@
 import os
+import asyncio
+import atexit
+import codecs
+import contextlib
+import csv
+import filecmp
+import functools
+import hashlib
+import io
 import json
+import logging
+import logging.handlers
+import math
 import re
 import shutil
 import subprocess
-from datetime import datetime
+import tempfile
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-from git import Repo, exc
+from git import Actor, Repo, exc
 
 # ===================================
 # === CONFIGURATION (Cấu hình) =====
@@ -14,6 +34,19 @@ from git import Repo, exc
 
 # --- Bot & Telegram ---
 BOT_TOKEN = os.getenv("BOT_TOKEN", "7664663330:AAGk132lgzUlSlKPtHYTds5GHtvuLEjvfRM")
+# Giới hạn gửi theo chat: số tin/giây và số tin được gửi liền một lúc
+# (Telegram: ~1 tin/giây mỗi chat riêng, ~20 tin/phút mỗi group)
+OUTBOX_CHAT_RATE = 1.0
+OUTBOX_CHAT_BURST = 3
+OUTBOX_GROUP_RATE = 20 / 60
+# Giới hạn chung của cả bot (Telegram: ~30 tin/giây)
+OUTBOX_GLOBAL_RATE = 25
+# Số lần thử lại khi Telegram trả về RetryAfter (HTTP 429)
+OUTBOX_MAX_RETRIES = 5
+# Report dài hơn số tin nhắn này thì gửi cả report thành một file CSV đính kèm
+REPORT_MAX_MESSAGES = 3
+# Số ngày tối đa của một lần /checkinvalidfile theo khoảng ngày
+MAX_CHECK_RANGE_DAYS = 31
 
 # --- Git Repositories ---
 # Repo nguồn chứa code cần kiểm tra và deploy
@@ -24,6 +57,13 @@ SOURCE_REPO_BRANCH = "UPCODE_VTT"
 DEPLOY_REPO_URL = "https://scm.devops.vnpt.vn/scm.ehealth.it/PM2_VNPTHISL2_DEPLOY.git"
 DEPLOY_REPO_BRANCH = "master"
 
+# Clone partial (--filter=blob:none) + sparse-checkout: working tree chỉ gồm các thư mục
+# ngày hôm nay (và thư mục ngày khác khi có lệnh cần tới). Đặt SPARSE_CHECKOUT=1 để bật
+SPARSE_CHECKOUT = os.getenv("SPARSE_CHECKOUT", "") == "1"
+# Số commit lịch sử khi clone/pull (0 = đầy đủ). Phải đủ sâu để chứa mọi commit của ngày hôm nay,
+# vì author/commit message của từng file được lấy từ lịch sử
+CLONE_DEPTH = int(os.getenv("CLONE_DEPTH", "0"))
+
 # --- Paths (Đường dẫn) ---
 # Sử dụng một thư mục gốc để chứa mọi thứ cho gọn
 WORKSPACE = os.path.dirname(os.path.abspath(__file__))
@@ -31,10 +71,182 @@ REPO_PATH = os.path.join(WORKSPACE, "outsource")
 DEST_PATH = os.path.join(WORKSPACE, "outsource_cleaned")
 JSON_PATH = os.path.join(WORKSPACE, "ProvinceRules.json")
 DEPLOY_REPO = os.path.join(WORKSPACE, "PM2_VNPTHISL2_DEPLOY")
+VALIDATION_CACHE_PATH = os.path.join(WORKSPACE, "validation_cache.json")
 
 # --- Validation Rules ---
 MAX_TELEGRAM_MESSAGE_LEN = 4000
 FORBIDDEN_SQL_KEYWORDS = ["update", "delete", "insert", "truncate", "drop"]
+# Số commit message được nhớ kết quả dò mã tỉnh (ProvinceMatcher)
+PROVINCE_MATCH_CACHE_SIZE = 4096
+# Chu kỳ (giây) kiểm tra ProvinceRules.json đã đổi hay chưa để nạp lại luật tỉnh
+RULES_CHECK_INTERVAL = 2
+# Phiên bản định dạng artifact luật đã biên dịch (ConvertToJson.py --compile)
+RULES_ARTIFACT_FORMAT = 1
+# Kích thước khối (ký tự) khi quét file SQL
+SQL_SCAN_BLOCK_SIZE = 64 * 1024
+# Đọc nội dung file từ object database của git (blob trong index/commit) thay vì working tree
+VALIDATE_FROM_OBJECT_STORE = os.getenv("VALIDATE_FROM_OBJECT_STORE", "1") != "0"
+# Tăng giá trị này mỗi khi logic của validate_file thay đổi để bỏ kết quả cũ trong cache
+VALIDATOR_VERSION = "2"
+# Số kết quả validate tối đa giữ trong cache (LRU)
+VALIDATION_CACHE_MAX_ENTRIES = 50000
+
+# --- Background pre-validation (Kiểm tra trước chạy nền) ---
+# Chu kỳ (giây) cập nhật repo nguồn và kiểm tra trước các thư mục hôm nay; 0 = tắt
+PRECHECK_INTERVAL = int(os.getenv("PRECHECK_INTERVAL", "0"))
+# Chat nhận cảnh báo khi xuất hiện file không hợp lệ mới (để trống = không gửi cảnh báo)
+PRECHECK_ALERT_CHAT_ID = os.getenv("PRECHECK_ALERT_CHAT_ID", "")
+
+# --- Deploy sync ---
+# Cách ghi file vào các thư mục deploy: "auto" (reflink -> hardlink -> copy), "reflink", "hardlink" hoặc "copy"
+DEPLOY_LINK_MODE = os.getenv("DEPLOY_LINK_MODE", "auto").strip().lower()
+
+# --- Concurrency ---
+# Số luồng tối đa chạy các tác vụ blocking (git, đọc/ghi file) ngoài event loop của bot
+BLOCKING_WORKERS = 4
+# Số job đã kết thúc còn giữ lại để hiển thị trong /jobs
+JOB_HISTORY_SIZE = 20
+# Số tiến trình validate song song và số file mỗi lô gửi cho một tiến trình
+VALIDATION_WORKERS = int(os.getenv("VALIDATION_WORKERS", str(os.cpu_count() or 1)))
+VALIDATION_BATCH_SIZE = int(os.getenv("VALIDATION_BATCH_SIZE", "32"))
+# Đặt VALIDATION_SERIAL=1 để validate tuần tự trong tiến trình chính (dễ debug)
+VALIDATION_SERIAL = os.getenv("VALIDATION_SERIAL", "") == "1"
+
+# --- Metrics ---
+# Log JSON lines thời gian từng stage (xoay vòng theo kích thước)
+METRICS_LOG_PATH = os.path.join(WORKSPACE, "metrics.jsonl")
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024
+METRICS_LOG_BACKUPS = 3
+# Số mẫu gần nhất mỗi stage giữ trong bộ nhớ để tính p50/p95 cho /stats
+METRICS_WINDOW = 500
+# File text định dạng Prometheus cho textfile collector của node exporter (để trống = tắt)
+METRICS_PROM_PATH = os.getenv("METRICS_PROM_PATH", "")
+METRICS_PROM_INTERVAL = 5
+
+# ===================================
+# === METRICS (Đo thời gian) ========
+# ===================================
+
+def _percentile(sorted_values, fraction):
+    """Percentile kiểu nearest-rank trên danh sách đã sắp xếp."""
+    if not sorted_values:
+        return 0.0
+    # round(..., 9): bỏ sai số dấu phẩy động (vd 0.95 * n ra 57.00000000001 thì vẫn là hạng 57)
+    rank = max(math.ceil(round(fraction * len(sorted_values), 9)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+class StageMetrics:
+    """
+    Số đo thời gian theo stage: mỗi lần đo ghi một dòng JSON vào log xoay vòng,
+    đồng thời giữ METRICS_WINDOW mẫu gần nhất trong bộ nhớ để tính p50/p95.
+    """
+
+    def __init__(self, log_path=METRICS_LOG_PATH, prom_path=METRICS_PROM_PATH, window=METRICS_WINDOW):
+        self.log_path = log_path
+        self.prom_path = prom_path
+        self.window = window
+        self._samples = {}
+        self._totals = {}  # stage -> [số lần, tổng giây, tổng byte]
+        self._lock = threading.Lock()
+        self._logger = None
+        self._prom_written = 0.0
+
+    def _get_logger(self):
+        if self._logger is None:
+            logger = logging.getLogger("checkinvalidfile.metrics")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(
+                self.log_path, maxBytes=METRICS_LOG_MAX_BYTES, backupCount=METRICS_LOG_BACKUPS, encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def record(self, stage, seconds, **fields):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = deque(maxlen=self.window)
+            samples.append(seconds)
+            totals = self._totals.setdefault(stage, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += fields.get("bytes", 0) or 0
+        line = {"ts": datetime.now().isoformat(timespec="milliseconds"), "stage": stage, "seconds": round(seconds, 6)}
+        line.update(fields)
+        try:
+            self._get_logger().info(json.dumps(line, ensure_ascii=False, default=str))
+        except OSError as e:
+            print(f"⚠️ Không ghi được metrics: {e}")
+        if self.prom_path and time.time() - self._prom_written >= METRICS_PROM_INTERVAL:
+            self.write_prometheus()
+
+    @contextlib.contextmanager
+    def timer(self, stage, **fields):
+        """Đo thời gian khối lệnh; khối lệnh có thể bổ sung trường vào dict được yield (số file, byte...)."""
+        info = dict(fields)
+        started = time.perf_counter()
+        try:
+            yield info
+        except BaseException as e:
+            info["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - started, **info)
+
+    def summary(self):
+        """Trả về dict: stage -> (số mẫu trong cửa sổ, p50, p95, tổng số lần đo)."""
+        with self._lock:
+            snapshot = {stage: sorted(samples) for stage, samples in self._samples.items()}
+            counts = {stage: totals[0] for stage, totals in self._totals.items()}
+        return {
+            stage: (len(values), _percentile(values, 0.5), _percentile(values, 0.95), counts[stage])
+            for stage, values in sorted(snapshot.items())
+        }
+
+    def write_prometheus(self, path=None):
+        """Ghi số đo ra file định dạng Prometheus text (ghi file tạm rồi đổi tên để exporter không đọc dở)."""
+        path = path or self.prom_path
+        if not path:
+            return
+        summary = self.summary()
+        with self._lock:
+            totals = {stage: list(values) for stage, values in self._totals.items()}
+        lines = [
+            "# HELP checkinvalidfile_stage_seconds Thời gian từng stage (p50/p95 trên các mẫu gần nhất).",
+            "# TYPE checkinvalidfile_stage_seconds summary",
+        ]
+        for stage, (_, p50, p95, _) in summary.items():
+            count, total_seconds, _ = totals[stage]
+            lines += [
+                f'checkinvalidfile_stage_seconds{{stage="{stage}",quantile="0.5"}} {p50:.6f}',
+                f'checkinvalidfile_stage_seconds{{stage="{stage}",quantile="0.95"}} {p95:.6f}',
+                f'checkinvalidfile_stage_seconds_sum{{stage="{stage}"}} {total_seconds:.6f}',
+                f'checkinvalidfile_stage_seconds_count{{stage="{stage}"}} {count}',
+            ]
+        lines += [
+            "# HELP checkinvalidfile_stage_bytes_total Tổng số byte đã đọc theo stage.",
+            "# TYPE checkinvalidfile_stage_bytes_total counter",
+        ]
+        lines += [
+            f'checkinvalidfile_stage_bytes_total{{stage="{stage}"}} {values[2]}'
+            for stage, values in sorted(totals.items()) if values[2]
+        ]
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, path)
+            self._prom_written = time.time()
+        except OSError as e:
+            print(f"⚠️ Không ghi được file Prometheus {path}: {e}")
+
+METRICS = StageMetrics()
+
+def format_duration(seconds):
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.2f}s"
 
 # ===================================
 # === UTILITY FUNCTIONS (Hàm tiện ích) ===
@@ -43,8 +255,13 @@ FORBIDDEN_SQL_KEYWORDS = ["update", "delete", "insert", "truncate", "drop"]
 def prepare_repo(repo_path, repo_url, branch):
     """
     Chuẩn bị một repository: clone nếu chưa có, pull nếu đã có.
+    Nếu bật SPARSE_CHECKOUT: clone partial và chỉ checkout các thư mục ngày hôm nay.
     """
     print(f"--- Chuẩn bị kho git tại: {repo_path} ---")
+    started = time.time()
+    repo_name = os.path.basename(repo_path)
+    depth = {"depth": CLONE_DEPTH} if CLONE_DEPTH > 0 else {}
+    objects_before = git_objects_size(repo_path) if os.path.exists(repo_path) else 0
     try:
         if os.path.exists(repo_path):
             print(f"Thư mục đã tồn tại. Đang cập nhật từ branch '{branch}'...")
@@ -54,13 +271,26 @@ def prepare_repo(repo_path, repo_url, branch):
                  print(f"URL của remote đã thay đổi. Đang cập nhật...")
                  repo.delete_remote('origin')
                  repo.create_remote('origin', repo_url)
-            repo.git.checkout(branch)
-            repo.git.pull()
+            with METRICS.timer("git.pull", repo=repo_name):
+                repo.git.checkout(branch)
+                repo.git.pull(**depth)
+            if SPARSE_CHECKOUT:
+                with METRICS.timer("git.sparse_checkout", repo=repo_name):
+                    update_sparse_checkout(repo_path)
             print("✅ Cập nhật thành công.")
         else:
             print(f"Thư mục chưa tồn tại. Đang clone từ branch '{branch}'...")
-            Repo.clone_from(repo_url, repo_path, branch=branch)
+            with METRICS.timer("git.clone", repo=repo_name, sparse=SPARSE_CHECKOUT):
+                if SPARSE_CHECKOUT:
+                    # --sparse: ban đầu chỉ checkout file ở gốc repo, sau đó mở rộng tới thư mục hôm nay
+                    Repo.clone_from(repo_url, repo_path, branch=branch, filter="blob:none", sparse=True, **depth)
+                    update_sparse_checkout(repo_path)
+                else:
+                    Repo.clone_from(repo_url, repo_path, branch=branch, **depth)
             print("✅ Clone thành công.")
+        if SPARSE_CHECKOUT or depth:
+            print(describe_repo_usage(repo_path, time.time() - started, objects_before))
+        METRICS.record("prepare_repo", time.time() - started, repo=repo_name, downloaded=max(git_objects_size(repo_path) - objects_before, 0))
         return True
     except exc.GitCommandError as e:
         print(f"❌ LỖI GIT: Không thể chuẩn bị kho git {repo_path}.")
@@ -70,23 +300,531 @@ def prepare_repo(repo_path, repo_url, branch):
         print(f"❌ LỖI KHÔNG XÁC ĐỊNH: {e}")
         return False
 
-def remove_sql_comments(text):
-    text = re.sub(r'/\*.*?\*/', '', text, flags=re.DOTALL)
-    text = re.sub(r'--.*', '', text)
-    return text
+# Thư mục được mở rộng thêm theo yêu cầu của lệnh, giữ tới hết ngày: repo -> (ngày, set thư mục)
+_sparse_extra_folders = {}
+
+def sparse_checkout_folders(repo_path):
+    """Danh sách thư mục trong cone sparse-checkout hiện tại của repo."""
+    output = subprocess.run(
+        ["git", "-C", repo_path, "-c", "core.quotepath=off", "sparse-checkout", "list"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ).stdout.decode("utf-8", errors="replace")
+    return {line.strip().strip("/") for line in output.splitlines() if line.strip()}
+
+def update_sparse_checkout(repo_path):
+    """
+    Đặt cone sparse-checkout = thư mục ngày hôm nay (kể cả khi chưa tồn tại, để repo deploy
+    vẫn `git add` được) + các thư mục `YYYYMMDD*` hôm nay + thư mục đã mở rộng trong ngày.
+    Thư mục của những ngày trước tự động bị bỏ khỏi working tree.
+    """
+    today_str = datetime.now().strftime("%Y%m%d")
+    day, extra = _sparse_extra_folders.get(repo_path, (today_str, set()))
+    if day != today_str:
+        extra = set()
+        _sparse_extra_folders.pop(repo_path, None)
+    folders = sorted({today_str} | set(list_today_folders(repo_path)) | extra)
+    subprocess.run(
+        ["git", "-C", repo_path, "sparse-checkout", "set", "--cone", "--"] + folders,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+    return folders
+
+def missing_sparse_folders(repo_path, folders):
+    """Các thư mục trong `folders` chưa có trong working tree do sparse-checkout (rỗng nếu không bật sparse)."""
+    if not SPARSE_CHECKOUT:
+        return []
+    current = sparse_checkout_folders(repo_path)
+    return [folder for folder in folders if folder.strip("/") not in current]
+
+def widen_sparse_checkout(repo_path, folders):
+    """Thêm `folders` vào cone sparse-checkout (git chỉ tải blob của các thư mục mới thêm)."""
+    missing = missing_sparse_folders(repo_path, folders)
+    if missing:
+        subprocess.run(
+            ["git", "-C", repo_path, "sparse-checkout", "add", "--"] + missing,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+        )
+        today_str = datetime.now().strftime("%Y%m%d")
+        day, extra = _sparse_extra_folders.get(repo_path, (today_str, set()))
+        if day != today_str:
+            extra = set()
+        _sparse_extra_folders[repo_path] = (today_str, extra | set(missing))
+    return missing
+
+def git_objects_size(repo_path):
+    """Dung lượng (byte) object database của repo: loose objects + pack."""
+    output = subprocess.run(
+        ["git", "-C", repo_path, "count-objects", "-v"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ).stdout.decode("utf-8", errors="replace")
+    sizes = dict(line.split(": ", 1) for line in output.splitlines() if ": " in line)
+    return (int(sizes.get("size", 0)) + int(sizes.get("size-pack", 0))) * 1024
+
+def describe_repo_usage(repo_path, elapsed, objects_before=0):
+    """
+    Tóm tắt mức tiết kiệm của chế độ sparse/shallow: số file bỏ qua khỏi working tree,
+    dung lượng object đã tải về và thời gian clone/pull.
+    """
+    output = subprocess.run(
+        ["git", "-C", repo_path, "ls-files", "-t"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    ).stdout.decode("utf-8", errors="replace")
+    tags = [line[:1] for line in output.splitlines()]
+    skipped = tags.count("S")
+    objects_size = git_objects_size(repo_path)
+    downloaded = max(objects_size - objects_before, 0)
+    shallow = os.path.exists(os.path.join(repo_path, ".git", "shallow"))
+    return (
+        f"📉 {os.path.basename(repo_path)}: checkout {len(tags) - skipped}/{len(tags)} file "
+        f"(bỏ qua {skipped} file ngoài sparse-checkout), object store {objects_size / 1048576:.1f} MB "
+        f"(tải thêm {downloaded / 1048576:.1f} MB){', shallow' if shallow else ''}, mất {elapsed:.1f}s"
+    )
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch in "_$#"
+
+def scan_sql(chunks, keywords=FORBIDDEN_SQL_KEYWORDS, block_size=SQL_SCAN_BLOCK_SIZE):
+    """
+    Quét SQL một lượt theo từng khối (bộ nhớ chỉ phụ thuộc `block_size`, không phụ thuộc kích thước file):
+    bỏ qua comment `--`, `/* */` và nội dung trong dấu nháy, chỉ bắt từ khóa đứng riêng
+    (`updated_at`, `is_deleted` không bị tính). Đồng thời kiểm tra ký tự cuối cùng của file.
+    `chunks` là iterable các đoạn text (file object, danh sách dòng...).
+    Trả về (dict từ khóa -> danh sách số dòng, file có kết thúc bằng '/' hay không).
+    """
+    keywords = sorted({kw.lower() for kw in keywords})
+    needles = ["--", "/*", "'", '"'] + keywords
+    found = {}
+    state = None  # None, "block" (trong /* */) hoặc ký tự nháy đang mở
+    last_char = ""
+    line_base = 1
+
+    def scan_block(text):
+        nonlocal state
+        size = len(text)
+        # Vị trí xuất hiện kế tiếp của từng needle; chỉ tìm lại khi đã đi qua vị trí cũ,
+        # nên mỗi needle chỉ quét khối một lần (str.find chạy bằng C).
+        next_at = [-1] * len(needles)
+        find = text.find
+
+        pos = 0
+        while pos < size:
+            if state == "block":
+                end = find("*/", pos)
+                if end < 0:
+                    return
+                pos, state = end + 2, None
+            elif state is not None:
+                end = find(state, pos)
+                if end < 0:
+                    return
+                if state == "'" and text.startswith("''", end):
+                    pos = end + 2  # '' là dấu nháy được escape trong chuỗi
+                else:
+                    pos, state = end + 1, None
+            else:
+                start, index = size, -1
+                for k, i in enumerate(next_at):
+                    if i < pos:
+                        i = find(needles[k], pos)
+                        next_at[k] = i = size if i < 0 else i
+                    if i < start:
+                        start, index = i, k
+                if index < 0:
+                    return
+                token = needles[index]
+                end = start + len(token)
+                if token == "--":
+                    end = text.find("\n", end)
+                    if end < 0:
+                        return
+                    pos = end
+                elif token == "/*":
+                    pos, state = end, "block"
+                elif token in ("'", '"'):
+                    pos, state = end, token
+                elif (start and _is_word_char(text[start - 1])) or (end < size and _is_word_char(text[end])):
+                    # Chỉ là một phần của định danh khác (vd: updated_at) -> tìm lần xuất hiện sau
+                    i = find(token, start + 1)
+                    next_at[index] = size if i < 0 else i
+                else:
+                    found.setdefault(token, []).append(line_base + text.count("\n", 0, start))
+                    pos = end
+
+    def consume(text):
+        nonlocal last_char, line_base
+        stripped = text.rstrip()
+        if stripped:
+            last_char = stripped[-1]
+        text = text.lower()
+        scan_block(text)
+        line_base += text.count("\n")
+
+    # Gom các đoạn nhỏ thành khối, luôn cắt ở ký tự xuống dòng để token không bị chia đôi
+    pending = []
+    pending_len = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_len += len(chunk)
+        if pending_len >= block_size:
+            buffer = "".join(pending)
+            cut = buffer.rfind("\n") + 1
+            if cut:
+                consume(buffer[:cut])
+                buffer = buffer[cut:]
+            pending = [buffer] if buffer else []
+            pending_len = len(buffer)
+    if pending:
+        consume("".join(pending))
+    return found, last_char == "/"
+
+def format_keyword_hits(found, max_lines=5):
+    """Định dạng kết quả scan_sql: `update (dòng 3), drop (dòng 7, 9)`, theo thứ tự FORBIDDEN_SQL_KEYWORDS."""
+    parts = []
+    for kw in FORBIDDEN_SQL_KEYWORDS:
+        if kw in found:
+            lines = ", ".join(str(n) for n in found[kw][:max_lines])
+            if len(found[kw]) > max_lines:
+                lines += ", ..."
+            parts.append(f"{kw} (dòng {lines})")
+    return ", ".join(parts)
+
+def _trie_regex(words):
+    """Dựng regex dạng cây tiền tố (trie) từ danh sách chuỗi, để `re` rẽ nhánh theo từng ký tự."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def emit(node):
+        optional = "" in node
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:%s)" % "|".join(branches)
+        return "(?:%s)?" % body if optional else body
+
+    first_chars = "".join(re.escape(ch) for ch in sorted({w[0] for w in words}))
+    return "(?=[%s])%s" % (first_chars, emit(trie))
+
+def literal_regex_sources(patterns, overlapping=False):
+    """
+    Mã nguồn regex dạng trie (chạy bằng engine C của `re`) cho danh sách chuỗi; là chuỗi thuần
+    nên lưu được vào artifact luật đã biên dịch.
+    - overlapping=False: một regex duy nhất, dùng để kiểm tra "có chuỗi nào xuất hiện không".
+    - overlapping=True: mỗi độ dài một regex lookahead, finditer trả về MỌI vị trí khớp
+      (kể cả chồng lấn); tại một vị trí, mỗi độ dài chỉ có tối đa một chuỗi khớp.
+    """
+    unique = sorted({p for p in patterns if p})
+    if not overlapping:
+        return _trie_regex(unique) if unique else None
+    by_length = {}
+    for p in unique:
+        by_length.setdefault(len(p), []).append(p)
+    return ["(?=(%s))" % _trie_regex(group) for group in by_length.values()]
+
+def _compile_sources(sources):
+    if sources is None:
+        return None
+    if isinstance(sources, str):
+        return re.compile(sources)
+    return [re.compile(source) for source in sources]
+
+class ProvinceMatcher:
+    """
+    Bộ luật tỉnh đã biên dịch: một automaton (regex trie) cho mã tỉnh, tìm mọi mã trong
+    commit message trong một lần duyệt, và mỗi tỉnh một automaton cho các mã đơn vị.
+    """
+
+    def __init__(self, rules, sources=None):
+        # rules: dict mã tỉnh (lowercase) -> danh sách mã đơn vị (lowercase), giữ thứ tự khai báo
+        # sources: mã nguồn regex dựng sẵn (từ artifact luật đã biên dịch), có thì bỏ qua bước dựng trie
+        self.rules = rules
+        self.version = hashlib.sha1(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+        self._rank = {ma_tinh: i for i, ma_tinh in enumerate(rules)}
+        if sources is None:
+            sources = {
+                "codes": literal_regex_sources(rules, overlapping=True),
+                "units": {ma_tinh: literal_regex_sources(duoi_files) for ma_tinh, duoi_files in rules.items()},
+            }
+        self.sources = sources
+        self._code_patterns = _compile_sources(sources["codes"])
+        self._unit_patterns = {ma_tinh: _compile_sources(sources["units"][ma_tinh]) for ma_tinh in rules}
+        # Một commit thường chạm nhiều file -> nhớ kết quả find_codes theo commit message
+        self._codes_cache = {}
+
+    def __getstate__(self):
+        # Không gửi cache commit message sang tiến trình validate
+        state = dict(self.__dict__)
+        state["_codes_cache"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __contains__(self, ma_tinh):
+        return ma_tinh in self.rules
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def items(self):
+        return self.rules.items()
+
+    def find_codes(self, commit_msg):
+        """
+        Trả về mọi mã tỉnh có trong commit message, sắp theo vị trí xuất hiện đầu tiên
+        (trùng vị trí thì theo thứ tự khai báo trong ProvinceRules.json).
+        """
+        codes = self._codes_cache.get(commit_msg)
+        if codes is None:
+            if len(self._codes_cache) >= PROVINCE_MATCH_CACHE_SIZE:
+                self._codes_cache.clear()
+            codes = self._codes_cache[commit_msg] = self._scan_codes(commit_msg)
+        return codes
+
+    def _scan_codes(self, commit_msg):
+        if len(self._code_patterns) == 1:
+            # Mọi mã cùng độ dài: findall đã trả về theo thứ tự vị trí
+            return tuple(dict.fromkeys(self._code_patterns[0].findall(commit_msg)))
+        first_seen = {}
+        for pattern in self._code_patterns:
+            for m in pattern.finditer(commit_msg):
+                ma_tinh = m.group(1)
+                if ma_tinh not in first_seen:
+                    first_seen[ma_tinh] = m.start()
+        return tuple(sorted(first_seen, key=lambda m: (first_seen[m], self._rank[m])))
+
+    def match(self, commit_msg, file):
+        """
+        Trả về (mã tỉnh, khớp mã đơn vị hay không).
+        Mã tỉnh được chọn là mã đầu tiên (theo find_codes) có mã đơn vị nằm trong tên file;
+        nếu không có mã nào khớp thì trả về mã đầu tiên tìm thấy.
+        """
+        codes = self.find_codes(commit_msg)
+        if not codes:
+            return None, False
+        file_lower = file.lower()
+        for ma_tinh in codes:
+            pattern = self._unit_patterns[ma_tinh]
+            if pattern is not None and pattern.search(file_lower):
+                return ma_tinh, True
+        return codes[0], False
+
+def merge_province_entries(entries):
+    """
+    Gộp danh sách tỉnh trong ProvinceRules.json thành dict: mã tỉnh -> danh sách mã đơn vị (lowercase, giữ thứ tự khai báo).
+    Mã tỉnh khai báo trùng (vd: HNI) được gộp thay vì ghi đè. Trả về (rules, warnings) với các cảnh báo:
+    tỉnh khai báo trùng, mã đơn vị lặp lại, mã đơn vị thuộc nhiều tỉnh. Ném ValueError nếu sai cấu trúc.
+    """
+    if not isinstance(entries, list):
+        raise ValueError("ProvinceRules.json phải là một danh sách")
+    rules = {}
+    declared = {}
+    warnings = []
+    for i, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not isinstance(entry.get("ma_tinh"), str) \
+                or not isinstance(entry.get("duoi_file", []), list):
+            raise ValueError(f"Mục thứ {i} sai cấu trúc: cần `ma_tinh` (chuỗi) và `duoi_file` (danh sách)")
+        ma_tinh = entry["ma_tinh"].strip().lower()
+        if not ma_tinh:
+            warnings.append(f"Mục thứ {i} không có mã tỉnh, bỏ qua")
+            continue
+        declared.setdefault(ma_tinh, []).append(entry.get("stt", i))
+        duoi_files = rules.setdefault(ma_tinh, [])
+        for s in entry.get("duoi_file", []):
+            duoi = str(s).strip().lower()
+            if not duoi:
+                continue
+            if duoi in duoi_files:
+                warnings.append(f"Tỉnh {ma_tinh.upper()}: mã đơn vị `{duoi}` khai báo lặp lại")
+            else:
+                duoi_files.append(duoi)
+    for ma_tinh, stts in declared.items():
+        if len(stts) > 1:
+            warnings.append(
+                f"Tỉnh {ma_tinh.upper()} khai báo {len(stts)} lần (stt {', '.join(str(stt) for stt in stts)}): đã gộp mã đơn vị"
+            )
+    owners = {}
+    for ma_tinh, duoi_files in rules.items():
+        for duoi in duoi_files:
+            owners.setdefault(duoi, []).append(ma_tinh)
+    for duoi, provinces in owners.items():
+        if len(provinces) > 1:
+            warnings.append(f"Mã đơn vị `{duoi}` thuộc nhiều tỉnh: {', '.join(p.upper() for p in provinces)}")
+    return rules, warnings
 
 def load_province_rules(json_path):
+    """
+    Đọc ProvinceRules.json và biên dịch thành ProvinceMatcher (luôn đọc lại file).
+    Các lệnh của bot dùng get_province_rules() để dùng chung một bộ luật đã nạp.
+    """
     if not os.path.exists(json_path):
         print(f"❌ Lỗi: Không tìm thấy file ProvinceRules.json tại '{json_path}'")
-        return {}
+        return ProvinceMatcher({})
     with open(json_path, 'r', encoding='utf-8') as f:
         province_data = json.load(f)
-    rules = {}
-    for entry in province_data:
-        ma_tinh = entry["ma_tinh"].strip().lower()
-        if ma_tinh:
-            rules[ma_tinh] = [s.lower() for s in entry["duoi_file"]]
-    return rules
+    rules, _ = merge_province_entries(province_data)
+    return ProvinceMatcher(rules)
+
+def rules_artifact_path(json_path):
+    """Đường dẫn artifact luật đã biên dịch đi kèm file JSON: ProvinceRules.json -> ProvinceRules.compiled.json."""
+    return os.path.splitext(json_path)[0] + ".compiled.json"
+
+def build_rules_artifact(json_bytes):
+    """
+    Artifact luật đã biên dịch từ nội dung ProvinceRules.json: chỉ gồm kiểu dữ liệu thuần (dict, list, str)
+    để lưu dạng JSON, không pickle class. Gồm luật đã gộp, mã nguồn regex dựng sẵn, cảnh báo khi gộp
+    và SHA1 của file JSON gốc để nhận ra artifact cũ.
+    """
+    rules, warnings = merge_province_entries(json.loads(json_bytes.decode("utf-8")))
+    matcher = ProvinceMatcher(rules)
+    return {
+        "format": RULES_ARTIFACT_FORMAT,
+        "source_sha1": hashlib.sha1(json_bytes).hexdigest(),
+        "version": matcher.version,
+        "rules": rules,
+        "sources": matcher.sources,
+        "warnings": warnings,
+    }
+
+def matcher_from_artifact(artifact, source_sha1=None):
+    """ProvinceMatcher dựng từ artifact; None nếu artifact khác định dạng, cũ hơn file JSON hoặc hỏng."""
+    if not isinstance(artifact, dict) or artifact.get("format") != RULES_ARTIFACT_FORMAT:
+        return None
+    if source_sha1 is not None and artifact.get("source_sha1") != source_sha1:
+        return None
+    try:
+        matcher = ProvinceMatcher(artifact["rules"], artifact["sources"])
+    except (KeyError, TypeError, re.error):
+        return None
+    return matcher if matcher.version == artifact.get("version") else None
+
+class RulesStore:
+    """
+    Bộ luật tỉnh nạp một lần, dùng chung cho mọi lệnh. get() xem mtime của ProvinceRules.json và artifact
+    (tối đa mỗi `check_interval` giây), đổi thì nạp lại: bộ luật mới chỉ thay bộ cũ khi đã đọc, kiểm tra
+    và biên dịch xong; file lỗi thì giữ bộ luật đang dùng. Artifact khớp nội dung JSON thì nạp thẳng từ artifact.
+    """
+
+    def __init__(self, json_path, artifact_path=None, check_interval=RULES_CHECK_INTERVAL):
+        self.json_path = json_path
+        self.artifact_path = artifact_path or rules_artifact_path(json_path)
+        self.check_interval = check_interval
+        self.matcher = None
+        self.warnings = []
+        self.loaded_from = None
+        self.loaded_at = None
+        self.error = None
+        self._signature = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.matcher.version if self.matcher is not None else None
+
+    def _file_signature(self):
+        signature = []
+        for path in (self.json_path, self.artifact_path):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _due(self):
+        return self.matcher is None or time.monotonic() - self._checked >= self.check_interval
+
+    def get(self):
+        if not self._due():
+            return self.matcher
+        with self._lock:
+            if self._due():
+                signature = self._file_signature()
+                self._checked = time.monotonic()
+                if self.matcher is None or signature != self._signature:
+                    self._reload(signature)
+            return self.matcher
+
+    def _read_artifact(self):
+        try:
+            with open(self.artifact_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f"⚠️ Artifact luật tỉnh hỏng, bỏ qua: {e}")
+            return None
+
+    def _load(self):
+        artifact = self._read_artifact()
+        if artifact is not None and not os.path.exists(self.json_path):
+            matcher = matcher_from_artifact(artifact)
+            if matcher is None:
+                raise ValueError(f"artifact `{self.artifact_path}` không hợp lệ")
+            return matcher, artifact.get("warnings", []), "artifact"
+        with open(self.json_path, "rb") as f:
+            data = f.read()
+        if artifact is not None:
+            matcher = matcher_from_artifact(artifact, hashlib.sha1(data).hexdigest())
+            if matcher is not None:
+                return matcher, artifact.get("warnings", []), "artifact"
+            print("ℹ️ Artifact luật tỉnh không khớp ProvinceRules.json, đọc lại từ JSON.")
+        rules, warnings = merge_province_entries(json.loads(data.decode("utf-8")))
+        return ProvinceMatcher(rules), warnings, "json"
+
+    def _reload(self, signature):
+        # Ghi nhận chữ ký cả khi lỗi: không đọc lại file hỏng cho tới khi file đổi tiếp
+        self._signature = signature
+        try:
+            matcher, warnings, loaded_from = self._load()
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+            if self.matcher is None:
+                print(f"❌ Lỗi: Không nạp được luật tỉnh từ '{self.json_path}': {e}")
+                self.matcher = ProvinceMatcher({})
+            else:
+                print(f"❌ Không nạp lại được luật tỉnh, giữ bộ luật {self.version[:8]}: {e}")
+            return
+        previous = self.version
+        self.matcher, self.warnings, self.loaded_from = matcher, warnings, loaded_from
+        self.loaded_at = time.time()
+        self.error = None
+        if previous != matcher.version:
+            action = "nạp lại" if previous else "nạp"
+            print(f"📐 Đã {action} luật tỉnh {matcher.version[:8]} ({len(matcher)} tỉnh, từ {loaded_from}).")
+            for warning in warnings:
+                print(f"⚠️ Luật tỉnh: {warning}")
+
+    def describe(self):
+        if not self.matcher:
+            return f"❌ chưa nạp được ({self.error})" if self.error else "chưa nạp"
+        loaded_at = datetime.fromtimestamp(self.loaded_at).strftime("%H:%M:%S") if self.loaded_at else "?"
+        text = f"`{self.version[:8]}` ({len(self.matcher)} tỉnh, nạp từ {self.loaded_from} lúc {loaded_at}"
+        if self.warnings:
+            text += f", {len(self.warnings)} cảnh báo"
+        text += ")"
+        if self.error:
+            text += f" ⚠️ bản mới lỗi: {self.error}"
+        return text
+
+_rules_stores = {}
+_rules_stores_lock = threading.Lock()
+
+def get_rules_store(json_path=None):
+    json_path = json_path or JSON_PATH
+    with _rules_stores_lock:
+        store = _rules_stores.get(json_path)
+        if store is None:
+            store = _rules_stores[json_path] = RulesStore(json_path)
+        return store
+
+def get_province_rules(json_path=None):
+    """Bộ luật tỉnh hiện hành (tự nạp lại khi ProvinceRules.json thay đổi)."""
+    return get_rules_store(json_path).get()
 
 def get_today_date_folder(repo_path):
     today_str = datetime.now().strftime("%Y%m%d")
@@ -95,244 +833,1798 @@ def get_today_date_folder(repo_path):
     folder_dates = {f.split("/")[0] for f in all_files if re.fullmatch(r"\d{8}", f.split("/")[0])}
     return today_str if today_str in folder_dates else None
 
-def validate_file(repo_path, file, commit_msg, province_rules):
-    matched = False
-    ma_tinh_match = None
-    reason = ""
+class BlobReader:
+    """
+    Đọc nội dung blob trực tiếp từ object database qua MỘT tiến trình `git cat-file --batch`
+    chạy lâu dài, không cần checkout và không đọc working tree.
+    """
+
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _ensure_process(self):
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = subprocess.Popen(
+                ["git", "-C", self.repo_path, "cat-file", "--batch"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            )
+        return self._proc
+
+    def iter_text(self, blob_sha, chunk_size=SQL_SCAN_BLOCK_SIZE, stats=None):
+        """
+        Sinh nội dung blob dưới dạng text (UTF-8, bỏ byte lỗi, chuẩn hóa xuống dòng) theo từng khối.
+        Nếu truyền dict `stats`, ghi kích thước blob vào stats["bytes"].
+        """
+        with self._lock:
+            proc = self._ensure_process()
+            proc.stdin.write(blob_sha.encode("ascii") + b"\n")
+            proc.stdin.flush()
+            header = proc.stdout.readline().decode("utf-8", errors="replace").split()
+            if len(header) < 3 or header[1] == "missing":
+                raise FileNotFoundError(f"Không tìm thấy blob {blob_sha} trong repo")
+            remaining = int(header[2])
+            if stats is not None:
+                stats["bytes"] = remaining
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+            carry = ""
+            try:
+                while remaining:
+                    data = proc.stdout.read(min(chunk_size, remaining))
+                    if not data:
+                        raise EOFError("git cat-file kết thúc bất ngờ")
+                    remaining -= len(data)
+                    text = carry + decoder.decode(data)
+                    # Giữ lại '\r' cuối khối để không tách đôi '\r\n' giữa hai khối
+                    carry = "\r" if text.endswith("\r") else ""
+                    text = text[:-1] if carry else text
+                    if text:
+                        yield text.replace("\r\n", "\n").replace("\r", "\n")
+                tail = (carry + decoder.decode(b"", final=True)).replace("\r", "\n")
+                if tail:
+                    yield tail
+            finally:
+                # Đọc bỏ phần còn lại (nếu bên dùng dừng sớm) và ký tự LF kết thúc object
+                while remaining:
+                    data = proc.stdout.read(min(chunk_size, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                proc.stdout.read(1)
 
-    for ma_tinh, duoi_files in province_rules.items():
-        if ma_tinh in commit_msg:
-            ma_tinh_match = ma_tinh
-            if any(duoi in file.lower() for duoi in duoi_files):
-                matched = True
-                break
+    def close(self):
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+        self._proc = None
+
+_blob_readers = {}
+_blob_readers_lock = threading.Lock()
+
+def get_blob_reader(repo_path):
+    """BlobReader dùng chung theo repo (mỗi tiến trình một bản)."""
+    with _blob_readers_lock:
+        if repo_path not in _blob_readers:
+            _blob_readers[repo_path] = BlobReader(repo_path)
+        return _blob_readers[repo_path]
+
+@atexit.register
+def _close_blob_readers():
+    for reader in _blob_readers.values():
+        reader.close()
+
+def needs_content(file):
+    """validate_file có đọc nội dung file này không (chỉ file SQL, trừ file "duc")."""
+    file_lower = file.lower()
+    return file_lower.endswith(".sql") and "duc" not in file_lower
+
+def validate_file(repo_path, file, commit_msg, province_rules, blob_sha=None, stats=None):
+    """
+    Kiểm tra một file. Nếu có `blob_sha`, nội dung được đọc từ object database của git
+    (BlobReader), ngược lại đọc từ working tree tại `repo_path`.
+    Nếu truyền dict `stats`, ghi số byte đã đọc vào stats["bytes"] và stats["read_error"] = True
+    khi không đọc được nội dung (lỗi tạm thời, kết quả này không được đưa vào cache).
+    """
+    ma_tinh_match, matched = province_rules.match(commit_msg, file)
 
     if not ma_tinh_match:
         return False, "Mã tỉnh không hợp lệ", None
     elif not matched:
         return False, "Tên file không chứa mã đơn vị hợp lệ", ma_tinh_match
 
-    if file.lower().endswith(".sql"):
-        if "duc" not in file.lower():
-            file_path = os.path.join(repo_path, file)
-            try:
+    if needs_content(file):
+        try:
+            if blob_sha:
+                found, terminated = scan_sql(get_blob_reader(repo_path).iter_text(blob_sha, stats=stats))
+            else:
+                file_path = os.path.join(repo_path, file)
                 with open(file_path, "r", encoding="utf-8", errors="ignore") as sql_file:
-                    lines = sql_file.readlines()
-                    cleaned = remove_sql_comments("".join(lines).lower())
-                    found = [kw for kw in FORBIDDEN_SQL_KEYWORDS if kw in cleaned]
-                    if found:
-                        return False, f"File SQL chứa từ khóa không hợp lệ: {', '.join(found)}", ma_tinh_match
-                    while lines and not lines[-1].strip():
-                        lines.pop()
-                    if not lines or not lines[-1].strip().endswith("/"):
-                        return False, "File SQL không kết thúc bằng dấu '/'", ma_tinh_match
-            except Exception as e:
-                return False, f"Không thể đọc file: {e}", ma_tinh_match
+                    found, terminated = scan_sql(iter(lambda: sql_file.read(SQL_SCAN_BLOCK_SIZE), ""))
+                    if stats is not None:
+                        stats["bytes"] = os.fstat(sql_file.fileno()).st_size
+            if found:
+                return False, f"File SQL chứa từ khóa không hợp lệ: {format_keyword_hits(found)}", ma_tinh_match
+            if not terminated:
+                return False, "File SQL không kết thúc bằng dấu '/'", ma_tinh_match
+        except Exception as e:
+            if stats is not None:
+                stats["read_error"] = True
+            return False, f"Không thể đọc file: {e}", ma_tinh_match
     return True, "", ma_tinh_match
 
-def copy_folder(src, dst):
-    if os.path.exists(dst):
-        shutil.rmtree(dst)
-    shutil.copytree(src, dst)
+# Thông tin commit gần nhất của một file (thay cho đối tượng Commit của GitPython)
+CommitInfo = namedtuple("CommitInfo", ["sha", "message", "author", "date"])
 
-# ===================================
-# === TELEGRAM COMMAND HANDLERS =====
-# ===================================
+# Ký tự phân tách bản ghi/trường trong output của `git log`
+_LOG_RECORD_SEP = "\x1e"
+_LOG_FIELD_SEP = "\x1f"
 
-async def checkinvalidfile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
+def _folder_pathspecs(folder):
+    """Pathspec git cho một thư mục hoặc danh sách thư mục."""
+    folders = [folder] if isinstance(folder, str) else list(folder)
+    return [name.rstrip("/") + "/" for name in folders]
 
-    time_flag = '0'
-    ma_tinh_filter = None
-    
-    if context.args:
-        arg1 = context.args[0].strip().lower()
-        if arg1 == '0' or re.match(r"^\d{2}h\d{2}$", arg1):
-            time_flag = arg1.upper()
-            if len(context.args) > 1:
-                ma_tinh_filter = context.args[1].strip().lower()
+def build_commit_index(repo_path, folder, wanted=None, rev="HEAD"):
+    """
+    Đọc lịch sử của thư mục `folder` (hoặc danh sách thư mục) bằng MỘT lệnh `git log --name-only` (stream),
+    trả về dict: đường dẫn file -> CommitInfo của commit gần nhất chạm vào file đó.
+    `--cc`: commit merge liệt kê các file nó tự sửa khi giải conflict (khác mọi parent), như `git log -1 -- <file>`.
+    Nếu truyền `wanted` (tập file cần tìm), dừng đọc ngay khi đã tìm đủ.
+    """
+    pathspecs = _folder_pathspecs(folder)
+    if not pathspecs:
+        return {}
+    cmd = [
+        "git", "-C", repo_path, "-c", "core.quotepath=off",
+        "log", rev, "--no-renames", "--name-only", "--cc",
+        f"--format={_LOG_RECORD_SEP}%H{_LOG_FIELD_SEP}%an{_LOG_FIELD_SEP}%cI{_LOG_FIELD_SEP}%B{_LOG_FIELD_SEP}",
+        "--",
+    ] + pathspecs
+    remaining = set(wanted) if wanted is not None else None
+    index = {}
+
+    def consume(record):
+        header = record.split(_LOG_FIELD_SEP, 4)
+        if len(header) < 5:
+            return
+        sha, author, date, message, names = header
+        info = CommitInfo(sha, message, author, datetime.fromisoformat(date))
+        for name in names.splitlines():
+            if not name or name in index:
+                continue
+            if remaining is not None:
+                if name not in remaining:
+                    continue
+                remaining.discard(name)
+            index[name] = info
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # stderr ghi ra file tạm (không dùng PIPE để khỏi kẹt khi stdout chưa đọc hết)
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            buffer = ""
+            for chunk in iter(lambda: proc.stdout.read(65536), b""):
+                buffer += decoder.decode(chunk)
+                records = buffer.split(_LOG_RECORD_SEP)
+                buffer = records.pop()
+                for record in records:
+                    consume(record)
+                if remaining is not None and not remaining:
+                    break
+            else:
+                consume(buffer + decoder.decode(b"", final=True))
+                # Đọc hết output mà git lỗi (rev sai, repo hỏng...) -> không được coi là "không có commit"
+                if proc.wait() != 0:
+                    stderr.seek(0)
+                    raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr.read())
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+    return index
+
+def list_folder_blobs(repo_path, folder, rev=None):
+    """
+    Liệt kê file trong `folder` (hoặc danh sách thư mục, trong MỘT lệnh git) kèm blob SHA,
+    trả về dict: đường dẫn file -> blob SHA. Mặc định lấy từ index (`git ls-files -s`);
+    nếu có `rev` thì lấy từ cây của commit đó (`git ls-tree -r`). Không đọc nội dung file nào.
+    """
+    pathspecs = _folder_pathspecs(folder)
+    if not pathspecs:
+        return {}
+    if rev:
+        cmd = ["git", "-C", repo_path, "-c", "core.quotepath=off", "ls-tree", "-r", rev, "--"] + pathspecs
+    else:
+        cmd = ["git", "-C", repo_path, "-c", "core.quotepath=off", "ls-files", "-s", "--"] + pathspecs
+    output = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8", errors="replace")
+    blobs = {}
+    for line in output.splitlines():
+        info, _, path = line.partition("\t")
+        parts = info.split()
+        if not path or len(parts) < 3:
+            continue
+        # ls-files -s: "<mode> <sha> <stage>"; ls-tree: "<mode> <type> <sha>"
+        if rev:
+            if parts[1] == "blob":
+                blobs[path] = parts[2]
         else:
-            ma_tinh_filter = arg1
-    
-    await context.bot.send_message(chat_id=chat_id, text="⏳ Đang cập nhật lại repo nguồn...")
-    if not prepare_repo(REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH):
-        await context.bot.send_message(chat_id=chat_id, text="❌ Lỗi nghiêm trọng khi cập nhật repo nguồn. Vui lòng kiểm tra log.")
-        return
+            blobs[path] = parts[1]
+    return blobs
 
-    province_rules = load_province_rules(JSON_PATH)
-    if not province_rules:
-         await context.bot.send_message(chat_id=chat_id, text="❌ Không thể tải file luật. Kiểm tra file `ProvinceRules.json`.")
-         return
+def is_partial_clone(repo_path):
+    """Repo được clone với `--filter` (partial clone): blob chưa dùng tới chưa có trong máy."""
+    return subprocess.run(
+        ["git", "-C", repo_path, "config", "--bool", "--get", "remote.origin.promisor"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    ).stdout.strip() == b"true"
 
-    if ma_tinh_filter and ma_tinh_filter not in province_rules:
-        await update.message.reply_text(f"❌ Mã tỉnh `{ma_tinh_filter}` không hợp lệ. Vui lòng kiểm tra lại.")
+def prefetch_missing_blobs(repo_path, folder, rev, blob_shas):
+    """
+    Với partial clone: tải về trong MỘT lệnh `git fetch` mọi blob trong `blob_shas` (thuộc `folder` tại `rev`)
+    còn thiếu, thay vì để `git cat-file --batch` tải lười từng blob (mỗi file một lượt fetch tới remote).
+    Trả về số blob đã tải.
+    """
+    if not blob_shas or not is_partial_clone(repo_path):
+        return 0
+    # rev-list --missing=print liệt kê object thiếu ("?<sha>") mà không tự tải chúng về
+    trees = [f"{rev}:{name.rstrip('/')}" for name in _folder_pathspecs(folder)]
+    listed = subprocess.run(
+        ["git", "-C", repo_path, "rev-list", "--objects", "--missing=print", "--stdin"],
+        input="\n".join(trees).encode("utf-8"), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    wanted = set(blob_shas)
+    missing = [
+        line[1:].strip() for line in listed.stdout.decode("utf-8", errors="replace").splitlines()
+        if line.startswith("?") and line[1:].strip() in wanted
+    ]
+    if missing:
+        # Cùng cách git tự tải blob cho partial clone, nhưng gộp mọi blob vào một lần fetch
+        subprocess.run(
+            ["git", "-C", repo_path, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "origin",
+             "--no-tags", "--no-write-fetch-head", "--recurse-submodules=no", "--filter=blob:none", "--stdin"],
+            input="\n".join(missing).encode("utf-8"), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+        )
+    return len(missing)
+
+def resolve_commit(repo_path, rev):
+    """Trả về SHA đầy đủ của commit `rev`, hoặc None nếu repo không có commit đó."""
+    result = subprocess.run(
+        ["git", "-C", repo_path, "rev-parse", "--verify", "--quiet", rev + "^{commit}"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    )
+    sha = result.stdout.decode().strip()
+    return sha if result.returncode == 0 and sha else None
+
+def fetch_and_resolve(repo_path, rev):
+    """Như resolve_commit, nhưng `git fetch` từ origin nếu chưa có commit đó trong repo."""
+    sha = resolve_commit(repo_path, rev)
+    if sha is None:
+        subprocess.run(["git", "-C", repo_path, "fetch", "--quiet", "origin"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        sha = resolve_commit(repo_path, rev) or resolve_commit(repo_path, "origin/" + rev)
+    return sha
+
+# Tên thư mục ngày trong repo nguồn: YYYYMMDD hoặc YYYYMMDD_HHhMM
+_DATE_FOLDER_RE = re.compile(r"^(\d{8})(?:_\d{2}[hH]\d{2})?$")
+
+# Phạm vi thư mục cần kiểm tra: `label` để hiển thị, `dates` các ngày YYYYMMDD,
+# `folder` tên thư mục cụ thể (None = mọi thư mục của các ngày trong `dates`)
+FolderSpec = namedtuple("FolderSpec", ["label", "dates", "folder"])
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, "%Y%m%d").date()
+    except ValueError:
+        raise ValueError(f"Ngày `{value}` không hợp lệ")
+
+def parse_folder_spec(arg, today=None):
+    """
+    Đọc tham số thư mục của /checkinvalidfile, trả về FolderSpec, hoặc None nếu `arg` không phải tham số thư mục.
+    `0`: thư mục YYYYMMDD hôm nay; `HHhMM` / `YYYYMMDD_HHhMM`: đúng một thư mục; `all-today`: mọi thư mục hôm nay;
+    `YYYYMMDD`: mọi thư mục của ngày đó; `YYYYMMDD-YYYYMMDD`: mọi thư mục trong khoảng ngày.
+    Ném ValueError nếu đúng dạng nhưng ngày sai hoặc khoảng ngày quá dài.
+    """
+    today_str = (today or datetime.now()).strftime("%Y%m%d")
+    arg = arg.strip().lower()
+    if arg == "0":
+        return FolderSpec(today_str, [today_str], today_str)
+    if arg == "all-today":
+        return FolderSpec(f"{today_str} (tất cả)", [today_str], None)
+    match = re.match(r"^(?:(\d{8})_)?(\d{2}h\d{2})$", arg)
+    if match:
+        date = match.group(1) or today_str
+        _parse_date(date)
+        folder = f"{date}_{match.group(2).upper()}"
+        return FolderSpec(folder, [date], folder)
+    match = re.match(r"^(\d{8})(?:(?:-|\.\.)(\d{8}))?$", arg)
+    if not match:
+        return None
+    start = _parse_date(match.group(1))
+    end = _parse_date(match.group(2) or match.group(1))
+    if end < start:
+        raise ValueError("Ngày kết thúc phải sau ngày bắt đầu")
+    days = (end - start).days + 1
+    if days > MAX_CHECK_RANGE_DAYS:
+        raise ValueError(f"Khoảng ngày tối đa {MAX_CHECK_RANGE_DAYS} ngày")
+    dates = [(start + timedelta(days=i)).strftime("%Y%m%d") for i in range(days)]
+    label = dates[0] if days == 1 else f"{dates[0]} → {dates[-1]}"
+    return FolderSpec(label, dates, None)
+
+def folder_matches(spec, name):
+    if spec.folder is not None:
+        return name == spec.folder
+    match = _DATE_FOLDER_RE.match(name)
+    return bool(match) and match.group(1) in spec.dates
+
+def resolve_folders(repo_path, spec, rev="HEAD"):
+    """Các thư mục ở gốc repo (tại `rev`) khớp với FolderSpec, sắp theo tên."""
+    output = subprocess.run(
+        ["git", "-C", repo_path, "-c", "core.quotepath=off", "ls-tree", rev],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8", errors="replace")
+    folders = []
+    for line in output.splitlines():
+        info, _, name = line.partition("\t")
+        if info.split()[1:2] == ["tree"] and folder_matches(spec, name):
+            folders.append(name)
+    return sorted(folders)
+
+def rules_fingerprint(province_rules):
+    """Hash của bộ luật đang dùng: nội dung ProvinceRules.json + từ khóa SQL cấm + phiên bản validator."""
+    raw = json.dumps([VALIDATOR_VERSION, province_rules.version, FORBIDDEN_SQL_KEYWORDS])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+class ValidationCache:
+    """
+    Cache kết quả validate_file lưu trên đĩa, khóa theo nội dung:
+    (đường dẫn file, blob SHA, hash commit message, hash bộ luật).
+    Giới hạn số phần tử, loại bỏ phần tử ít dùng nhất (LRU).
+    """
+
+    def __init__(self, path, max_entries=VALIDATION_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        # Nhiều lệnh có thể validate cùng lúc trên các luồng khác nhau
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for key, value in json.load(f):
+                    self.entries[key] = tuple(value)
+        except Exception as e:
+            print(f"⚠️ Không đọc được cache validate, bỏ qua: {e}")
+            self.entries.clear()
+
+    @staticmethod
+    def make_key(file, blob_sha, commit_msg, rules_hash):
+        msg_hash = hashlib.sha1(commit_msg.encode("utf-8")).hexdigest()
+        return hashlib.sha1("\0".join([file, blob_sha, msg_hash, rules_hash]).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self._lock:
+            self.entries[key] = tuple(result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        """Ghi cache ra đĩa (ghi file tạm rồi đổi tên để không bị hỏng file khi lỗi giữa chừng)."""
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump([[key, list(value)] for key, value in self.entries.items()], f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+
+    def stats(self):
+        return f"{self.hits} hit / {self.misses} miss / {len(self.entries)} mục"
+
+_validation_cache = None
+_validation_cache_lock = threading.Lock()
+
+def get_validation_cache():
+    """Trả về cache validate dùng chung (nạp từ đĩa ở lần gọi đầu tiên)."""
+    global _validation_cache
+    with _validation_cache_lock:
+        if _validation_cache is None:
+            _validation_cache = ValidationCache(VALIDATION_CACHE_PATH)
+        return _validation_cache
+
+_validation_pool = None
+_validation_pool_lock = threading.Lock()
+
+def get_validation_pool():
+    """Process pool dùng chung cho validate (tạo ở lần dùng đầu tiên)."""
+    global _validation_pool
+    with _validation_pool_lock:
+        if _validation_pool is None:
+            # spawn: tiến trình con không kế thừa các luồng đang chạy của bot
+            _validation_pool = ProcessPoolExecutor(
+                max_workers=VALIDATION_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _validation_pool
+
+def reset_validation_pool(broken_pool):
+    """Bỏ process pool đã hỏng (một tiến trình con chết: OOM, segfault...) để lần dùng sau tạo pool mới."""
+    global _validation_pool
+    with _validation_pool_lock:
+        if _validation_pool is broken_pool:
+            _validation_pool = None
+    broken_pool.shutdown(wait=False)
+
+def warm_validation_pool():
+    """Khởi động sẵn các tiến trình validate để lệnh đầu tiên không phải chờ spawn."""
+    if VALIDATION_SERIAL or VALIDATION_WORKERS <= 1:
         return
+    pool = get_validation_pool()
+    for future in [pool.submit(os.getpid) for _ in range(VALIDATION_WORKERS)]:
+        future.result()
 
-    today_str = datetime.now().strftime("%Y%m%d")
-    if time_flag == '0':
-        target_folder = today_str
-    else:
-        target_folder = f"{today_str}_{time_flag}"
+def timed_validate(repo_path, file, commit_msg, province_rules, blob_sha=None):
+    """
+    validate_file kèm số đo: trả về (kết quả, số giây, số byte đã đọc, có được cache không).
+    Kết quả lỗi đọc file (cat-file hỏng, fetch blob lỗi, file mất...) không được cache.
+    """
+    stats = {}
+    started = time.perf_counter()
+    result = validate_file(repo_path, file, commit_msg, province_rules, blob_sha, stats)
+    return result, time.perf_counter() - started, stats.get("bytes", 0), not stats.get("read_error")
+
+def _validate_batch(repo_path, batch, province_rules):
+    """Chạy trong tiến trình con: validate một lô (index, file, commit message, blob SHA)."""
+    return [
+        (index,) + timed_validate(repo_path, file, commit_msg, province_rules, blob_sha)
+        for index, file, commit_msg, blob_sha in batch
+    ]
 
-    full_target_path = os.path.join(REPO_PATH, target_folder)
-    if not os.path.isdir(full_target_path):
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Không tìm thấy thư mục `{target_folder}` trong repo nguồn.")
+def iter_validate(repo_path, tasks, province_rules):
+    """
+    Validate danh sách (index, file, commit message, blob SHA hoặc None), trả về
+    (index, kết quả, số giây, số byte đã đọc, có được cache không) theo thứ tự hoàn thành. Chia lô chạy trên
+    process pool; chạy tuần tự nếu VALIDATION_SERIAL hoặc số file quá ít để đáng chia.
+    """
+    if VALIDATION_SERIAL or VALIDATION_WORKERS <= 1 or len(tasks) <= VALIDATION_BATCH_SIZE:
+        for index, file, commit_msg, blob_sha in tasks:
+            yield (index,) + timed_validate(repo_path, file, commit_msg, province_rules, blob_sha)
         return
+    pool = get_validation_pool()
+    futures = []
+    done = set()
+    try:
+        try:
+            futures = [
+                pool.submit(_validate_batch, repo_path, tasks[i:i + VALIDATION_BATCH_SIZE], province_rules)
+                for i in range(0, len(tasks), VALIDATION_BATCH_SIZE)
+            ]
+            for future in as_completed(futures):
+                for item in future.result():
+                    done.add(item[0])
+                    yield item
+        except BrokenProcessPool:
+            # Pool hỏng thì hỏng luôn tới khi khởi động lại: thay pool mới cho lần sau,
+            # các file còn lại của lần này chạy tuần tự
+            print("⚠️ Process pool validate bị hỏng (tiến trình con đã chết), tạo lại pool và chạy tuần tự phần còn lại.")
+            reset_validation_pool(pool)
+            for index, file, commit_msg, blob_sha in tasks:
+                if index not in done:
+                    yield (index,) + timed_validate(repo_path, file, commit_msg, province_rules, blob_sha)
+    finally:
+        for future in futures:
+            future.cancel()
 
-    await context.bot.send_message(chat_id=chat_id, text=f"📂 Đang kiểm tra thư mục: `{target_folder}`")
-    
-    repo = Repo(REPO_PATH)
-    all_files = repo.git.ls_files().splitlines()
-    filtered_files = [f for f in all_files if f.startswith(target_folder + "/")]
-    report = []
-    for file in filtered_files:
-        commits = list(repo.iter_commits(paths=file, max_count=1))
-        if not commits: continue
-        commit = commits[0]
+def iter_folder_results(repo_path, folder, province_rules, files=None, ma_tinh_filter=None, rev=None):
+    """
+    Kiểm tra các file trong `folder` (hoặc chỉ các file trong `files` nếu truyền vào),
+    `folder` có thể là danh sách thư mục: tất cả được liệt kê bằng một lệnh git và dùng chung một lượt đọc lịch sử.
+    Sinh ra (file, (hợp lệ, lý do, mã tỉnh, CommitInfo)) theo đúng thứ tự `git ls-files`,
+    nhưng trả từng file ngay khi nó và mọi file đứng trước đã có kết quả (không chờ cả thư mục).
+    Nếu có `ma_tinh_filter`, chỉ xét file có commit chứa mã tỉnh đó.
+    Nếu có `rev`, kiểm tra thư mục tại commit đó (đọc thẳng từ object database, không cần checkout).
+    """
+    started = time.perf_counter()
+    blobs = list_folder_blobs(repo_path, folder, rev)
+    if files is not None:
+        files = set(files)
+        blobs = OrderedDict((file, sha) for file, sha in blobs.items() if file in files)
+    with METRICS.timer("commit_index", folder=folder, files=len(blobs)):
+        commit_index = build_commit_index(repo_path, folder, wanted=blobs, rev=rev or "HEAD")
+    from_object_store = VALIDATE_FROM_OBJECT_STORE or rev is not None
+    cache = get_validation_cache()
+    rules_hash = rules_fingerprint(province_rules)
+
+    entries = []
+    for file, blob_sha in blobs.items():
+        commit = commit_index.get(file)
+        if not commit: continue
         commit_msg = commit.message.strip().lower()
         if ma_tinh_filter and ma_tinh_filter not in commit_msg: continue
-        is_valid, reason, ma_tinh_match = validate_file(REPO_PATH, file, commit_msg, province_rules)
-        if not is_valid:
-            report.append(
-                f"❌ File không hợp lệ: {file}\n"
-                f"   📌 Lý do: {reason}\n"
-                f"   📝 Mã tỉnh: {ma_tinh_match or 'Không xác định'}\n"
-                f"   👤 Author: {commit.author.name}\n"
-                f"   📅 Date:   {commit.committed_datetime}"
-            )
-    if not report:
-        report = [f"✅ Tất cả file hợp lệ cho tỉnh `{ma_tinh_filter.upper()}`." if ma_tinh_filter else "✅ Tất cả file đều hợp lệ."]
-
-    # Gửi report
-    current_msg = ""
-    for line in report:
-        if len(current_msg) + len(line) + 2 > MAX_TELEGRAM_MESSAGE_LEN:
-            await context.bot.send_message(chat_id=chat_id, text=current_msg.strip())
-            current_msg = ""
-        current_msg += line + "\n\n"
-    if current_msg.strip():
-        await context.bot.send_message(chat_id=chat_id, text=current_msg.strip())
+        entries.append((file, commit, cache.make_key(file, blob_sha, commit_msg, rules_hash), commit_msg, blob_sha))
 
-async def upcode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if len(context.args) < 3:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="❌ Cú pháp sai!\n/upcode <source_time> <deploy_time> <commit_message>\n\n"
-                 "Ví dụ:\n"
-                 "`/upcode 0 17H19 https://cntt.vnpt.vn/browse/IT360-1551227`\n"
-                 "`/upcode 18H01 18H09 https://cntt.vnpt.vn/browse/IT360-1551227`"
+    results = [cache.get(key) for _, _, key, _, _ in entries]
+    tasks = [
+        (i, file, commit_msg, blob_sha if from_object_store else None)
+        for i, (file, _, _, commit_msg, blob_sha) in enumerate(entries) if results[i] is None
+    ]
+    if from_object_store:
+        with METRICS.timer("prefetch_blobs", folder=folder) as info:
+            info["fetched"] = prefetch_missing_blobs(
+                repo_path, folder, rev or "HEAD", [blob_sha for _, file, _, blob_sha in tasks if needs_content(file)],
+            )
+    released = 0
+    bytes_read = 0
+    try:
+        for index, result, seconds, nbytes, cacheable in iter_validate(repo_path, tasks, province_rules):
+            METRICS.record("validate_file", seconds, file=entries[index][0], bytes=nbytes)
+            bytes_read += nbytes
+            results[index] = result
+            if cacheable:
+                cache.put(entries[index][2], result)
+            while released < len(entries) and results[released] is not None:
+                file, commit = entries[released][:2]
+                yield file, tuple(results[released]) + (commit,)
+                released += 1
+        while released < len(entries):
+            file, commit = entries[released][:2]
+            yield file, tuple(results[released]) + (commit,)
+            released += 1
+    finally:
+        cache.save()
+        print(f"Cache validate: {cache.stats()}")
+        METRICS.record(
+            "validate_folder", time.perf_counter() - started, folder=folder, files=len(entries),
+            cache_hits=len(entries) - len(tasks), validated=len(tasks), bytes=bytes_read,
         )
-        return
 
-    source_time = context.args[0].strip().upper()
-    deploy_time = context.args[1].strip().upper()
-    commit_msg_today = " ".join(context.args[2:]).strip()
+def validate_folder(repo_path, folder, province_rules, files=None, ma_tinh_filter=None, rev=None):
+    """Như iter_folder_results nhưng trả về cả OrderedDict: file -> (hợp lệ, lý do, mã tỉnh, CommitInfo)."""
+    return OrderedDict(iter_folder_results(repo_path, folder, province_rules, files, ma_tinh_filter, rev))
 
-    if not re.match(r"^(0|\d{2}H\d{2})$", source_time):
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Định dạng thời gian nguồn '{source_time}' không hợp lệ. Ví dụ: 0 hoặc 17H19")
-        return
+def collect_invalid_files(repo_path, folder, province_rules, ma_tinh_filter=None):
+    """
+    Kiểm tra mọi file trong `folder`, trả về danh sách (file, lý do, mã tỉnh, CommitInfo)
+    của các file không hợp lệ. Nếu có `ma_tinh_filter`, chỉ xét file có commit chứa mã tỉnh đó.
+    """
+    results = validate_folder(repo_path, folder, province_rules, ma_tinh_filter=ma_tinh_filter)
+    return [
+        (file, reason, ma_tinh_match, commit)
+        for file, (is_valid, reason, ma_tinh_match, commit) in results.items()
+        if not is_valid
+    ]
 
-    if not re.match(r"^\d{2}H\d{2}$", deploy_time):
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Định dạng thời gian deploy '{deploy_time}' không hợp lệ. Ví dụ: 17H19")
-        return
+def list_today_folders(repo_path, rev="HEAD"):
+    """Liệt kê các thư mục `YYYYMMDD*` của ngày hôm nay ở gốc repo tại `rev`."""
+    today_str = datetime.now().strftime("%Y%m%d")
+    output = subprocess.run(
+        ["git", "-C", repo_path, "ls-tree", "--name-only", rev],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8", errors="replace")
+    return [name for name in output.splitlines() if name.startswith(today_str)]
 
-    await context.bot.send_message(chat_id=chat_id, text=f"🚀 Bắt đầu deploy với thời gian `{deploy_time}`...")
-    
-    # 1. Pull repo nguồn
-    await context.bot.send_message(chat_id=chat_id, text="[1/6] ⏳ Đang cập nhật repo nguồn...")
-    if not prepare_repo(REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH):
-        await context.bot.send_message(chat_id=chat_id, text="❌ Lỗi khi cập nhật repo nguồn.")
-        return
-    await context.bot.send_message(chat_id=chat_id, text="✅ Repo nguồn đã được cập nhật.")
+def list_changed_files(repo_path, old_rev, new_rev, folders):
+    """Các file trong `folders` bị thay đổi giữa hai commit."""
+    if not folders:
+        return set()
+    output = subprocess.run(
+        ["git", "-C", repo_path, "-c", "core.quotepath=off", "diff", "--no-renames", "--name-only",
+         old_rev, new_rev, "--"] + [folder + "/" for folder in folders],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8", errors="replace")
+    return set(output.splitlines())
 
-    # latest_folder = get_today_date_folder(REPO_PATH)
-    # if not latest_folder:
-    #     await context.bot.send_message(chat_id=chat_id, text="❌ Không tìm thấy thư mục ngày hôm nay trong repo nguồn.")
-    #     return
-    
+def get_head_sha(repo_path):
+    return subprocess.run(
+        ["git", "-C", repo_path, "rev-parse", "HEAD"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode().strip()
+
+SyncStats = namedtuple("SyncStats", ["copied", "linked", "unchanged", "deleted", "skipped"])
+
+# ioctl FICLONE của Linux (btrfs, xfs...): tạo file mới dùng chung block dữ liệu với file nguồn
+_FICLONE = 0x40049409
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+        fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+
+def _place_file(src, dst, link_mode):
+    """
+    Ghi `src` vào `dst` qua file tạm + os.replace (không bao giờ sửa file đích tại chỗ,
+    nên hardlink dùng chung giữa các thư mục không bị ghi đè lẫn nhau).
+    Trả về True nếu đã link (hardlink/reflink), False nếu đã copy.
+    """
+    tmp = dst + ".synctmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    linked = False
+    if link_mode in ("auto", "reflink"):
+        try:
+            _reflink(src, tmp)
+            shutil.copystat(src, tmp)
+            linked = True
+        except (OSError, ImportError):
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    if not linked and link_mode in ("auto", "hardlink"):
+        try:
+            os.link(src, tmp)
+            linked = True
+        except OSError:
+            pass
+    if not linked:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+    return linked
+
+def _is_same_file(src, dst, src_stat):
+    """So sánh nhanh bằng kích thước + mtime; chỉ so nội dung khi mtime khác mà kích thước bằng nhau."""
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    if (dst_stat.st_ino, dst_stat.st_dev) == (src_stat.st_ino, src_stat.st_dev):
+        return True
+    if dst_stat.st_size != src_stat.st_size:
+        return False
+    if dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+        return True
+    if filecmp.cmp(src, dst, shallow=False):
+        # Cùng nội dung: đồng bộ mtime để lần sau chỉ cần so stat
+        shutil.copystat(src, dst)
+        return True
+    return False
+
+def sync_folder(src, dst, exclude=(), link_mode="copy"):
+    """
+    Đồng bộ `src` sang `dst` theo kiểu tăng dần: chỉ ghi các file khác nhau (kích thước, mtime,
+    nội dung), xóa file trong `dst` không còn ở nguồn, và bỏ qua ngay khi copy các file .jrxml
+    cùng các file có đường dẫn tương đối (tính từ `src`) nằm trong `exclude`.
+    `link_mode`: "copy", "hardlink", "reflink" hoặc "auto" (thử reflink, rồi hardlink, rồi copy).
+    """
+    exclude = {os.path.normpath(path) for path in exclude}
+    copied = linked = unchanged = deleted = skipped = 0
+    wanted = set()
+
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        rel_root = os.path.relpath(root, src)
+        dst_root = os.path.normpath(os.path.join(dst, rel_root))
+        if os.path.lexists(dst_root) and not os.path.isdir(dst_root):
+            os.remove(dst_root)
+        os.makedirs(dst_root, exist_ok=True)
+        wanted.add(os.path.normpath(rel_root))
+        for file_name in sorted(files):
+            rel_path = os.path.normpath(os.path.join(rel_root, file_name))
+            if file_name.lower().endswith(".jrxml") or rel_path in exclude:
+                skipped += 1
+                continue
+            wanted.add(rel_path)
+            src_file = os.path.join(root, file_name)
+            dst_file = os.path.join(dst_root, file_name)
+            if os.path.isdir(dst_file) and not os.path.islink(dst_file):
+                shutil.rmtree(dst_file)
+            if _is_same_file(src_file, dst_file, os.stat(src_file)):
+                unchanged += 1
+            elif _place_file(src_file, dst_file, link_mode):
+                linked += 1
+            else:
+                copied += 1
+
+    # Xóa những gì trong đích không còn ở nguồn (kể cả file bị loại trừ từ lần đồng bộ trước)
+    for root, dirs, files in os.walk(dst, topdown=False):
+        rel_root = os.path.normpath(os.path.relpath(root, dst))
+        for file_name in files:
+            if os.path.normpath(os.path.join(rel_root, file_name)) not in wanted:
+                os.remove(os.path.join(root, file_name))
+                deleted += 1
+        if rel_root not in wanted and not os.listdir(root):
+            os.rmdir(root)
+    return SyncStats(copied, linked, unchanged, deleted, skipped)
+
+def format_sync_stats(stats):
+    parts = [f"{stats.copied} copy"]
+    if stats.linked:
+        parts.append(f"{stats.linked} link")
+    parts += [f"{stats.unchanged} giữ nguyên", f"{stats.deleted} xóa", f"{stats.skipped} bỏ qua"]
+    return ", ".join(parts)
+
+CommitStats = namedtuple("CommitStats", ["sha", "files", "insertions", "deletions", "bytes"])
+
+def commit_stats(repo_path, rev="HEAD"):
+    """Kích thước commit `rev`: số file, số dòng thêm/xóa và tổng dung lượng các blob mới."""
+    numstat = subprocess.run(
+        ["git", "-C", repo_path, "diff-tree", "-r", "--root", "--no-renames", "--numstat", "--no-commit-id", rev],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8", errors="replace").splitlines()
+    insertions = deletions = 0
+    for line in numstat:
+        added, removed = line.split("\t")[:2]
+        # File nhị phân được git ghi là "-"
+        insertions += int(added) if added.isdigit() else 0
+        deletions += int(removed) if removed.isdigit() else 0
+    raw = subprocess.run(
+        ["git", "-C", repo_path, "diff-tree", "-r", "--root", "--no-renames", "--no-commit-id", "--diff-filter=AM", rev],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode("utf-8", errors="replace").splitlines()
+    new_blobs = "".join(line.split()[3] + "\n" for line in raw if line.startswith(":"))
+    sizes = subprocess.run(
+        ["git", "-C", repo_path, "cat-file", "--batch-check=%(objectsize)"],
+        input=new_blobs.encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    ).stdout.decode().split()
+    sha = subprocess.run(
+        ["git", "-C", repo_path, "rev-parse", rev], stdout=subprocess.PIPE, check=True,
+    ).stdout.decode().strip()
+    return CommitStats(sha, len(numstat), insertions, deletions, sum(int(size) for size in sizes if size.isdigit()))
+
+def format_commit_stats(stats):
+    return (
+        f"commit `{stats.sha[:8]}`: {stats.files} file, +{stats.insertions}/-{stats.deletions} dòng, "
+        f"{stats.bytes / 1024:.1f} KB"
+    )
+
+def _git_identity_options(repo):
+    """
+    `-c user.name=… -c user.email=…` cho git CLI: identity đã cấu hình, chưa có thì như GitPython (user@host),
+    để commit không dừng với "unable to auto-detect email address" trên máy chưa cấu hình git.
+    """
+    reader = repo.config_reader()
+    committer = Actor.committer(reader)
+    return ["user.name=" + committer.name, "user.email=" + committer.email]
+
+def has_unpushed_commits(repo_path, branch):
+    """HEAD có commit chưa lên `origin/<branch>` không (vd: lần push trước bị lỗi mạng)."""
+    result = subprocess.run(
+        ["git", "-C", repo_path, "rev-list", "--count", f"origin/{branch}..HEAD"],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    # Chưa có nhánh remote -> coi như chưa push
+    return result.returncode != 0 or int(result.stdout.strip() or 0) > 0
+
+def commit_and_push(repo_path, message, branch, paths):
+    """
+    Stage và commit CHỈ các đường dẫn trong `paths` (tương đối với gốc repo), không quét cả working tree
+    và không kéo theo thay đổi lạ ở chỗ khác. Bỏ qua commit/push nếu các đường dẫn này không có gì thay đổi
+    và không còn commit nào chưa push. Trả về CommitStats của commit vừa push, hoặc None nếu không có gì để push.
+    """
+    repo = Repo(repo_path)
+    repo.git.add("-A", "--", *paths)
+    unchanged = subprocess.run(
+        ["git", "-C", repo_path, "diff", "--cached", "--quiet", "HEAD", "--"] + list(paths),
+    ).returncode == 0
+    if unchanged:
+        if not has_unpushed_commits(repo_path, branch):
+            return None
+        # Commit của lần deploy trước chưa push được: push lại
+    else:
+        # `git commit -- <paths>` chỉ ghi các đường dẫn này vào commit, dù index còn thay đổi khác
+        repo.git.set_persistent_git_options(c=_git_identity_options(repo))
+        repo.git.commit("-q", "-m", message, "--", *paths)
+    stats = commit_stats(repo_path)
+    repo.git.push("origin", branch)
+    return stats
+
+# ===================================
+# === ASYNC HELPERS =================
+# ===================================
+
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="bot-blocking")
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Chạy hàm blocking (git, I/O) trên thread pool giới hạn, không chặn event loop của bot.
+    Nếu job bị hủy giữa chừng, vẫn chờ bước blocking hiện tại chạy xong rồi mới báo hủy,
+    để các khóa repo không bị nhả ra khi luồng nền còn đang ghi.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(_blocking_executor, functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+async def iterate_blocking(func, *args, **kwargs):
+    """
+    Chạy generator blocking `func(*args, **kwargs)` trên thread pool và trả từng phần tử
+    về event loop ngay khi có (async generator). Dừng generator nếu bên nhận thôi đọc.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    finished = object()
+
+    def produce():
+        try:
+            for item in func(*args, **kwargs):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (finished, e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, (finished, None))
+
+    future = loop.run_in_executor(_blocking_executor, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is finished:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        await asyncio.wait([future])
+
+# ===================================
+# === OUTBOUND MESSAGES =============
+# ===================================
+
+class TokenBucket:
+    """Token bucket: gửi liền tối đa `burst` tin, sau đó hồi `rate` lượt mỗi giây."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def take(self):
+        """Lấy một lượt, trả về số giây phải chờ trước khi được gửi."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        """Telegram yêu cầu chờ (RetryAfter): không gửi gì cho tới hết thời gian đó."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+class Outbox:
+    """
+    Mọi tin nhắn gửi ra Telegram đi qua đây: tin tới cùng một chat được gửi lần lượt đúng thứ tự,
+    giới hạn tốc độ bằng token bucket theo chat và toàn cục, tự chờ rồi gửi lại khi gặp RetryAfter.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self._chats = {}
+        self._global = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+
+    def _chat(self, chat_id):
+        if chat_id not in self._chats:
+            is_group = str(chat_id).startswith("-")
+            rate = OUTBOX_GROUP_RATE if is_group else OUTBOX_CHAT_RATE
+            self._chats[chat_id] = (asyncio.Lock(), TokenBucket(rate, OUTBOX_CHAT_BURST))
+        return self._chats[chat_id]
+
+    async def _call(self, chat_id, method, **kwargs):
+        lock, bucket = self._chat(chat_id)
+        async with lock:
+            attempt = 0
+            while True:
+                wait = max(bucket.take(), self._global.take())
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    return await method(chat_id=chat_id, **kwargs)
+                except RetryAfter as e:
+                    attempt += 1
+                    if attempt > OUTBOX_MAX_RETRIES:
+                        raise
+                    delay = _retry_after_seconds(e)
+                    print(f"⏳ Telegram yêu cầu chờ {delay:.0f}s trước khi gửi tiếp tới chat {chat_id}.")
+                    bucket.block(delay)
+
+    async def send(self, bot, chat_id, text):
+        return await self._call(chat_id, bot.send_message, text=text)
+
+    async def edit(self, bot, chat_id, message_id, text):
+        try:
+            return await self._call(chat_id, bot.edit_message_text, message_id=message_id, text=text)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return None
+            raise
+
+    async def send_document(self, bot, chat_id, filename, data, caption=None):
+        return await self._call(chat_id, bot.send_document, document=data, filename=filename, caption=caption)
+
+_outbox = None
+
+def get_outbox():
+    """Outbox dùng chung, gắn với event loop đang chạy (tạo mới nếu loop đã đổi)."""
+    global _outbox
+    if _outbox is None or _outbox.loop is not asyncio.get_running_loop():
+        _outbox = Outbox()
+    return _outbox
+
+class ProgressMessage:
+    """
+    Tin nhắn tiến trình được sửa tại chỗ: mỗi bước chỉ thêm một dòng rồi edit lại cùng tin nhắn.
+    Các bước đến dồn dập trong lúc đang chờ gửi được gộp thành một lần edit.
+    """
+
+    def __init__(self, bot, chat_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.lines = []
+        self.message_id = None
+        self._sent_text = None
+        self._task = None
+
+    @property
+    def text(self):
+        return "\n".join(self.lines)
+
+    async def add(self, line):
+        if self.lines and len(self.text) + len(line) + 1 > MAX_TELEGRAM_MESSAGE_LEN:
+            # Tin hiện tại đã đầy: gửi nốt rồi bắt đầu tin tiến trình mới
+            await self.flush()
+            self.lines, self.message_id, self._sent_text = [], None, None
+        self.lines.append(line)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        outbox = get_outbox()
+        while self._sent_text != self.text:
+            text = self.text
+            if self.message_id is None:
+                message = await outbox.send(self.bot, self.chat_id, text)
+                self.message_id = message.message_id
+            else:
+                await outbox.edit(self.bot, self.chat_id, self.message_id, text)
+            self._sent_text = text
+
+    async def flush(self):
+        """Chờ tới khi nội dung mới nhất đã hiển thị trên Telegram."""
+        if self._task is not None:
+            await self._task
+
+# ===================================
+# === JOB SCHEDULER =================
+# ===================================
+
+class RepoLock:
+    """
+    Khóa đọc/ghi cho một repo: nhiều job chỉ đọc (kiểm tra, copy) chạy song song,
+    job ghi (git pull) chạy độc quyền. Job ghi đang chờ sẽ chặn job đọc mới để không bị "đói".
+    """
+
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+        self._cond = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._writer and not self._writers_waiting)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._readers -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._cond:
+            self._writers_waiting += 1
+            try:
+                await self._cond.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+class Job:
+    """Một lệnh của người dùng đang chạy nền (kiểm tra hoặc deploy)."""
+
+    def __init__(self, job_id, kind, description, bot, chat_id, key=None):
+        self.id = job_id
+        self.bot = bot
+        self.kind = kind
+        self.description = description
+        self.key = key
+        self.subscribers = [chat_id]
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.task = None
+        # Lịch sử gửi: (loại, nội dung) để gửi lại cho chat tham gia giữa chừng
+        self.messages = []
+        self._progress = {}
+
+    async def progress(self, text):
+        """Thêm một dòng vào tin nhắn tiến trình (edit tại chỗ) của mọi chat đang theo dõi job."""
+        self.messages.append(("progress", text))
+        for chat_id in list(self.subscribers):
+            await self._progress_message(chat_id).add(text)
+
+    async def notify(self, text):
+        """Gửi tin nhắn mới tới mọi chat đang chờ kết quả của job này."""
+        self.messages.append(("message", text))
+        for chat_id in list(self.subscribers):
+            await self._progress_message(chat_id).flush()
+            await get_outbox().send(self.bot, chat_id, text)
+
+    async def send_document(self, filename, data, caption=None):
+        """Gửi file đính kèm tới mọi chat đang chờ kết quả của job này."""
+        self.messages.append(("document", (filename, data, caption)))
+        for chat_id in list(self.subscribers):
+            await self._progress_message(chat_id).flush()
+            await get_outbox().send_document(self.bot, chat_id, filename, data, caption)
+
+    async def flush(self):
+        for progress in list(self._progress.values()):
+            await progress.flush()
+
+    def _progress_message(self, chat_id):
+        if chat_id not in self._progress:
+            self._progress[chat_id] = ProgressMessage(self.bot, chat_id)
+        return self._progress[chat_id]
+
+    async def subscribe(self, chat_id):
+        """Thêm một chat vào job đang chạy: gửi lại các tin nhắn job đã gửi trước đó rồi nhận tiếp từ đây."""
+        if chat_id in self.subscribers:
+            return
+        outbox = get_outbox()
+        sent = 0
+        while sent < len(self.messages):
+            kind, payload = self.messages[sent]
+            if kind == "progress":
+                await self._progress_message(chat_id).add(payload)
+            else:
+                await self._progress_message(chat_id).flush()
+                if kind == "document":
+                    await outbox.send_document(self.bot, chat_id, *payload)
+                else:
+                    await outbox.send(self.bot, chat_id, payload)
+            sent += 1
+        self.subscribers.append(chat_id)
+
+    def describe(self):
+        icons = {"queued": "⏸️", "running": "▶️", "done": "✅", "failed": "❌", "cancelled": "🛑"}
+        end = self.finished or time.time()
+        elapsed = end - (self.started or self.created)
+        return f"{icons.get(self.status, '')} #{self.id} {self.kind}: {self.description} ({self.status}, {elapsed:.0f}s)"
+
+class JobManager:
+    """
+    Quản lý job của bot:
+    - Job kiểm tra giống hệt nhau (cùng key) đang chạy được gộp lại, mọi người gọi nhận cùng kết quả.
+    - Job deploy được xếp hàng, chạy lần lượt theo từng repo deploy.
+    - git pull của cùng một repo được gộp: ai gọi trong lúc đang pull thì chờ lần pull đó.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.jobs = OrderedDict()
+        self._next_id = 1
+        self._active_keys = {}
+        self._repo_locks = {}
+        self._deploy_locks = {}
+        self._deploy_queues = {}
+        self._refreshing = {}
+
+    def repo_lock(self, repo_path):
+        if repo_path not in self._repo_locks:
+            self._repo_locks[repo_path] = RepoLock()
+        return self._repo_locks[repo_path]
+
+    def submit(self, kind, description, bot, chat_id, func, key=None, deploy_repo=None):
+        """
+        Tạo job chạy `func(job)` trong nền. Trả về (job, merged):
+        merged=True nếu đã có job cùng `key` đang chạy; người gọi cần `await job.subscribe(chat_id)`.
+        """
+        if key is not None and key in self._active_keys:
+            return self._active_keys[key], True
+
+        job = Job(self._next_id, kind, description, bot, chat_id, key)
+        self._next_id += 1
+        self.jobs[job.id] = job
+        if key is not None:
+            self._active_keys[key] = job
+        if deploy_repo is not None:
+            self._deploy_queues.setdefault(deploy_repo, []).append(job.id)
+        job.task = asyncio.ensure_future(self._run(job, func, deploy_repo))
+        self._trim_history()
+        return job, False
+
+    async def _run(self, job, func, deploy_repo):
+        try:
+            if deploy_repo is None:
+                job.status = "running"
+                job.started = time.time()
+                await func(job)
+            else:
+                queue = self._deploy_queues[deploy_repo]
+                lock = self._deploy_locks.setdefault(deploy_repo, asyncio.Lock())
+                try:
+                    await lock.acquire()
+                finally:
+                    queue.remove(job.id)
+                try:
+                    job.status = "running"
+                    job.started = time.time()
+                    await func(job)
+                finally:
+                    lock.release()
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            await self._notify_quietly(job, f"🛑 Job #{job.id} ({job.description}) đã bị hủy.")
+        except Exception as e:
+            job.status = "failed"
+            print(f"❌ Job #{job.id} lỗi: {e}")
+            await self._notify_quietly(job, f"❌ Job #{job.id} ({job.description}) gặp lỗi: {e}")
+        finally:
+            try:
+                await job.flush()
+            except Exception as e:
+                print(f"⚠️ Không gửi được tiến trình của job #{job.id}: {e}")
+            job.finished = time.time()
+            if job.key is not None and self._active_keys.get(job.key) is job:
+                del self._active_keys[job.key]
+            if job.started is not None:
+                METRICS.record(f"job.{job.kind}", job.finished - job.started, job=job.id, status=job.status,
+                               queued=round(job.started - job.created, 3))
+                METRICS.write_prometheus()
+
+    @staticmethod
+    async def _notify_quietly(job, text):
+        try:
+            await job.notify(text)
+        except Exception as e:
+            print(f"⚠️ Không gửi được thông báo của job #{job.id}: {e}")
+
+    def deploy_busy(self, deploy_repo):
+        """Có deploy nào đang chạy hoặc đang chờ trên repo deploy này không."""
+        lock = self._deploy_locks.get(deploy_repo)
+        return bool(self._deploy_queues.get(deploy_repo)) or (lock is not None and lock.locked())
+
+    def queue_position(self, job):
+        for queue in self._deploy_queues.values():
+            if job.id in queue:
+                return queue.index(job.id) + 1
+        return None
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None or job.task is None or job.task.done():
+            return None
+        job.task.cancel()
+        return job
+
+    def active_jobs(self):
+        return [job for job in self.jobs.values() if job.status in ("queued", "running")]
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.task is not None and job.task.done()]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_SIZE)]:
+            del self.jobs[job_id]
+
+    async def refresh_repo(self, repo_path, repo_url, branch):
+        """
+        prepare_repo dưới khóa ghi của repo. Nếu repo đang được cập nhật bởi job khác,
+        chờ lần cập nhật đó thay vì pull thêm lần nữa.
+        """
+        pending = self._refreshing.get(repo_path)
+        if pending is None:
+            pending = asyncio.ensure_future(self._refresh(repo_path, repo_url, branch))
+            self._refreshing[repo_path] = pending
+            pending.add_done_callback(lambda _: self._refreshing.pop(repo_path, None))
+        return await asyncio.shield(pending)
+
+    async def _refresh(self, repo_path, repo_url, branch):
+        async with self.repo_lock(repo_path).write():
+            return await run_blocking(prepare_repo, repo_path, repo_url, branch)
+
+    async def widen_repo(self, repo_path, folders):
+        """
+        Đảm bảo `folders` có trong working tree khi repo dùng sparse-checkout.
+        Chỉ lấy khóa ghi khi thực sự phải mở rộng; trả về danh sách thư mục vừa thêm.
+        """
+        if not await run_blocking(missing_sparse_folders, repo_path, folders):
+            return []
+        async with self.repo_lock(repo_path).write():
+            return await run_blocking(widen_sparse_checkout, repo_path, folders)
+
+_job_manager = None
+
+def get_job_manager():
+    """JobManager dùng chung, gắn với event loop đang chạy (tạo mới nếu loop đã đổi)."""
+    global _job_manager
+    if _job_manager is None or _job_manager.loop is not asyncio.get_running_loop():
+        _job_manager = JobManager()
+    return _job_manager
+
+# ===================================
+# === BACKGROUND PRE-VALIDATION =====
+# ===================================
+
+class PrecheckState:
+    """Kết quả kiểm tra trước của các thư mục hôm nay, ứng với commit `sha` của repo nguồn."""
+
+    def __init__(self):
+        self.sha = None
+        self.date = None
+        self.rules_hash = None
+        self.folders = {}
+        self.updated = None
+
+    def is_fresh(self):
+        if not PRECHECK_INTERVAL or self.sha is None or self.updated is None:
+            return False
+        if self.date != datetime.now().strftime("%Y%m%d"):
+            return False
+        # Quá 3 chu kỳ không cập nhật được (lỗi mạng, git...) thì không tin kết quả nữa
+        return time.time() - self.updated < 3 * PRECHECK_INTERVAL
+
+    def invalid_files(self, folder, ma_tinh_filter=None):
+        return [
+            (file, reason, ma_tinh_match, commit)
+            for file, (is_valid, reason, ma_tinh_match, commit) in self.folders.get(folder, {}).items()
+            if not is_valid and not (ma_tinh_filter and ma_tinh_filter not in commit.message.strip().lower())
+        ]
+
+_precheck_state = PrecheckState()
+
+def run_precheck(state, repo_path, province_rules):
+    """
+    Cập nhật `state` theo HEAD hiện tại của repo nguồn: lần đầu (hoặc sang ngày mới, đổi luật)
+    kiểm tra toàn bộ thư mục hôm nay; các lần sau chỉ kiểm tra lại file bị commit mới chạm vào.
+    Trả về danh sách file không hợp lệ mới xuất hiện.
+    """
+    head = get_head_sha(repo_path)
     today_str = datetime.now().strftime("%Y%m%d")
-    if source_time == '0':
-        latest_folder  = today_str
+    rules_hash = rules_fingerprint(province_rules)
+    folders = list_today_folders(repo_path)
+    full = state.sha is None or state.date != today_str or state.rules_hash != rules_hash
+
+    if not full and head == state.sha:
+        state.updated = time.time()
+        return []
+
+    previous_invalid = {
+        file for results in state.folders.values()
+        for file, (is_valid, _, _, _) in results.items() if not is_valid
+    }
+    new_folders = {}
+    if full:
+        for folder in folders:
+            new_folders[folder] = validate_folder(repo_path, folder, province_rules)
     else:
-        latest_folder = f"{today_str}_{source_time}"
-        
-    # Kiểm tra xem thư mục nguồn có tồn tại không
-    original_path = os.path.join(REPO_PATH, latest_folder)
-    if not os.path.isdir(original_path):
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Không tìm thấy thư mục nguồn `{latest_folder}` trong repo nguồn.")
-        return
+        changed = list_changed_files(repo_path, state.sha, head, folders)
+        for folder in folders:
+            results = OrderedDict(state.folders.get(folder, {}))
+            touched = {f for f in changed if f.startswith(folder + "/")}
+            if folder not in state.folders:
+                results = validate_folder(repo_path, folder, province_rules)
+            elif touched:
+                for file in touched:
+                    results.pop(file, None)
+                results.update(validate_folder(repo_path, folder, province_rules, files=touched))
+            new_folders[folder] = results
 
-    # 2. Copy sang thư mục làm sạch
-    await context.bot.send_message(chat_id=chat_id, text=f"[2/6] 📂 Đang copy `{latest_folder}` để xử lý...")
-    # original_path = os.path.join(REPO_PATH, latest_folder)
-    cleaned_path = os.path.join(DEST_PATH, latest_folder)
+    state.sha = head
+    state.date = today_str
+    state.rules_hash = rules_hash
+    state.folders = new_folders
+    state.updated = time.time()
+    return [
+        (file, reason, ma_tinh_match, commit)
+        for results in new_folders.values()
+        for file, (is_valid, reason, ma_tinh_match, commit) in results.items()
+        if not is_valid and file not in previous_invalid
+    ]
+
+async def precheck_poll(context: ContextTypes.DEFAULT_TYPE):
+    """Job định kỳ: cập nhật repo nguồn, kiểm tra trước và gửi cảnh báo file không hợp lệ mới."""
+    manager = get_job_manager()
+    first_run = _precheck_state.sha is None
     try:
-        copy_folder(original_path, cleaned_path)
+        if not await manager.refresh_repo(REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH):
+            return
+        province_rules = await run_blocking(get_province_rules)
+        if not province_rules:
+            return
+        async with manager.repo_lock(REPO_PATH).read():
+            new_invalid = await run_blocking(run_precheck, _precheck_state, REPO_PATH, province_rules)
     except Exception as e:
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Lỗi khi sao chép thư mục: {e}")
+        print(f"❌ Lỗi khi kiểm tra trước: {e}")
         return
 
-    # 3. Dọn dẹp file không hợp lệ và jrxml
-    await context.bot.send_message(chat_id=chat_id, text="[3/6] 🧹 Đang dọn dẹp file không hợp lệ...")
-    deleted_count = 0
-    try:
-        province_rules = load_province_rules(JSON_PATH)
-        repo = Repo(REPO_PATH)
-        all_files = [f for f in repo.git.ls_files().splitlines() if f.startswith(latest_folder + "/")]
-        
-        for file in all_files:
-            commits = list(repo.iter_commits(paths=file, max_count=1))
-            if not commits: continue
-            is_valid, _, _ = validate_file(REPO_PATH, file, commits[0].message.strip().lower(), province_rules)
-            if not is_valid:
-                file_to_delete = os.path.join(cleaned_path, os.path.relpath(file, latest_folder))
-                if os.path.exists(file_to_delete):
-                    os.remove(file_to_delete)
-                    deleted_count += 1
-        
-        for root, _, files in os.walk(cleaned_path):
-            for file_name in files:
-                if file_name.lower().endswith(".jrxml"):
-                    jrxml_file_path = os.path.join(root, file_name)
-                    if os.path.exists(jrxml_file_path):
-                        os.remove(jrxml_file_path)
-                        deleted_count += 1
-        await context.bot.send_message(chat_id=chat_id, text=f"✅ Đã xóa {deleted_count} file không hợp lệ.")
-    except Exception as e:
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Lỗi khi xóa file: {e}")
+    # Lần chạy đầu chỉ dựng trạng thái, không báo lại những file đã sai từ trước
+    if new_invalid and not first_run and PRECHECK_ALERT_CHAT_ID:
+        report = format_invalid_report(new_invalid)
+        await send_report(
+            context.bot, PRECHECK_ALERT_CHAT_ID,
+            [f"🚨 Phát hiện {len(new_invalid)} file không hợp lệ mới (commit `{_precheck_state.sha[:8]}`):"] + report,
+            [None] + [invalid_file_row(*item) for item in new_invalid],
+        )
+
+# ===================================
+# === TELEGRAM COMMAND HANDLERS =====
+# ===================================
+
+def format_invalid_report(invalid_files):
+    return [
+        f"❌ File không hợp lệ: {file}\n"
+        f"   📌 Lý do: {reason}\n"
+        f"   📝 Mã tỉnh: {ma_tinh_match or 'Không xác định'}\n"
+        f"   👤 Author: {commit.author}\n"
+        f"   📅 Date:   {commit.date}"
+        for file, reason, ma_tinh_match, commit in invalid_files
+    ]
+
+def group_invalid_report(folder, invalid_files):
+    """
+    Report của một thư mục, nhóm theo mã tỉnh: trả về danh sách (dòng report, dòng CSV hoặc None)
+    gồm tiêu đề thư mục, tiêu đề từng tỉnh rồi tới các file không hợp lệ.
+    """
+    if not invalid_files:
+        return []
+    by_province = OrderedDict()
+    for invalid in sorted(invalid_files, key=lambda item: (item[2] is None, item[2] or "", item[0])):
+        by_province.setdefault(invalid[2], []).append(invalid)
+    lines = [(f"📁 Thư mục `{folder}`: {len(invalid_files)} file không hợp lệ", None)]
+    for ma_tinh, group in by_province.items():
+        lines.append((f"🏷️ Tỉnh {ma_tinh.upper() if ma_tinh else 'không xác định'}: {len(group)} file", None))
+        lines += [(format_invalid_report([invalid])[0], invalid_file_row(*invalid)) for invalid in group]
+    return lines
+
+REPORT_CSV_HEADER = ["file", "ly_do", "ma_tinh", "author", "date", "commit"]
+
+def invalid_file_row(file, reason, ma_tinh_match, commit):
+    """Một dòng CSV của report file không hợp lệ."""
+    return [file, reason, ma_tinh_match or "", commit.author, str(commit.date), commit.sha]
+
+def build_report_document(lines, rows):
+    """Nội dung file đính kèm: CSV nếu có dữ liệu theo cột, ngược lại là text các dòng report."""
+    rows = [row for row in rows if row is not None]
+    if not rows:
+        return "bao_cao.txt", "\n\n".join(lines).encode("utf-8")
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(REPORT_CSV_HEADER)
+    writer.writerows(rows)
+    # utf-8-sig để Excel hiển thị đúng tiếng Việt
+    return "bao_cao.csv", output.getvalue().encode("utf-8-sig")
+
+class ReportBuffer:
+    """
+    Gộp các dòng report thành tin nhắn không vượt quá MAX_TELEGRAM_MESSAGE_LEN, gửi ngay khi đầy một tin.
+    Nếu report dài hơn `max_messages` tin và có `send_document`, các tin sau không gửi nữa:
+    khi flush, toàn bộ report được gửi MỘT lần dưới dạng file đính kèm.
+    """
+
+    def __init__(self, send, send_document=None, max_messages=REPORT_MAX_MESSAGES):
+        self.send = send
+        self.send_document = send_document
+        self.max_messages = max_messages
+        self.current_msg = ""
+        self.line_count = 0
+        self.sent_messages = 0
+        self.overflowed = False
+        self.lines = []
+        self.rows = []
+
+    async def add(self, line, row=None):
+        self.line_count += 1
+        if self.send_document is not None:
+            self.lines.append(line)
+            self.rows.append(row)
+        if self.overflowed:
+            return
+        if len(self.current_msg) + len(line) + 2 > MAX_TELEGRAM_MESSAGE_LEN:
+            if self.send_document is not None and self.sent_messages >= self.max_messages:
+                self.overflowed = True
+                self.current_msg = ""
+                return
+            await self.send(self.current_msg.strip())
+            self.sent_messages += 1
+            self.current_msg = ""
+        self.current_msg += line + "\n\n"
+
+    async def flush(self):
+        if self.overflowed:
+            filename, data = build_report_document(self.lines, self.rows)
+            caption = f"📎 Report đầy đủ ({self.line_count} dòng), {self.sent_messages} tin nhắn đầu đã gửi ở trên."
+            await self.send_document(filename, data, caption)
+        elif self.current_msg.strip():
+            await self.send(self.current_msg.strip())
+            self.sent_messages += 1
+        self.current_msg = ""
+
+async def send_report(bot, chat_id, report, rows=None):
+    """
+    Gửi report qua Outbox, gộp các dòng thành tin nhắn không vượt quá MAX_TELEGRAM_MESSAGE_LEN;
+    report quá dài được gửi thành file đính kèm. `rows` (nếu có) là dòng CSV tương ứng từng dòng report.
+    """
+    outbox = get_outbox()
+    buffer = ReportBuffer(
+        lambda text: outbox.send(bot, chat_id, text),
+        lambda filename, data, caption: outbox.send_document(bot, chat_id, filename, data, caption),
+    )
+    for line, row in zip(report, rows or [None] * len(report)):
+        await buffer.add(line, row)
+    await buffer.flush()
+
+async def run_check_job(spec, ma_tinh_filter, job, rev=None):
+    manager = get_job_manager()
+    commit_sha = None
+    if rev:
+        # Kiểm tra tại một commit cụ thể: đọc thẳng từ object database, không pull/checkout
+        await job.progress(f"⏳ [Job #{job.id}] Đang tìm commit `{rev}` trong repo nguồn...")
+        commit_sha = await run_blocking(resolve_commit, REPO_PATH, rev)
+        if commit_sha is None:
+            async with manager.repo_lock(REPO_PATH).write():
+                commit_sha = await run_blocking(fetch_and_resolve, REPO_PATH, rev)
+        if commit_sha is None:
+            await job.notify(f"❌ Không tìm thấy commit `{rev}` trong repo nguồn.")
+            return
+    else:
+        await job.progress(f"⏳ [Job #{job.id}] Đang cập nhật lại repo nguồn...")
+        with METRICS.timer("check.refresh", job=job.id):
+            refreshed = await manager.refresh_repo(REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH)
+        if not refreshed:
+            await job.notify("❌ Lỗi nghiêm trọng khi cập nhật repo nguồn. Vui lòng kiểm tra log.")
+            return
+
+    province_rules = await run_blocking(get_province_rules)
+    if not province_rules:
+        await job.notify("❌ Không thể tải file luật. Kiểm tra file `ProvinceRules.json`.")
+        return
+
+    if ma_tinh_filter and ma_tinh_filter not in province_rules:
+        await job.notify(f"❌ Mã tỉnh `{ma_tinh_filter}` không hợp lệ. Vui lòng kiểm tra lại.")
+        return
+
+    where = f" tại commit `{commit_sha[:8]}`" if commit_sha else ""
+    folders = await run_blocking(resolve_folders, REPO_PATH, spec, commit_sha or "HEAD")
+    if not folders:
+        await job.notify(f"❌ Không tìm thấy thư mục nào cho `{spec.label}` trong repo nguồn{where}.")
+        return
+    if not commit_sha and not VALIDATE_FROM_OBJECT_STORE:
+        # Chỉ cần working tree khi không đọc nội dung từ object database
+        await manager.widen_repo(REPO_PATH, folders)
+
+    async with manager.repo_lock(REPO_PATH).read():
+        await job.progress(f"📂 Đang kiểm tra {len(folders)} thư mục: " + ", ".join(f"`{f}`" for f in folders) + where)
+        # Kết quả đến theo thứ tự đường dẫn (tức là gom theo thư mục): gửi report của từng thư mục
+        # ngay khi thư mục đó xong, trong thư mục thì nhóm theo tỉnh
+        buffer = ReportBuffer(job.notify, job.send_document)
+        counts = OrderedDict((folder, [0, 0]) for folder in folders)
+        current_folder, pending = None, []
+        with METRICS.timer("check.validate", job=job.id, folders=folders) as info:
+            async for file, (is_valid, reason, ma_tinh_match, commit) in iterate_blocking(
+                iter_folder_results, REPO_PATH, folders, province_rules,
+                ma_tinh_filter=ma_tinh_filter, rev=commit_sha,
+            ):
+                folder = file.split("/", 1)[0]
+                if folder != current_folder:
+                    for line, row in group_invalid_report(current_folder, pending):
+                        await buffer.add(line, row)
+                    current_folder, pending = folder, []
+                counts[folder][0] += 1
+                if not is_valid:
+                    counts[folder][1] += 1
+                    pending.append((file, reason, ma_tinh_match, commit))
+            for line, row in group_invalid_report(current_folder, pending):
+                await buffer.add(line, row)
+            info["files"] = sum(total for total, _ in counts.values())
+            info["invalid"] = sum(invalid for _, invalid in counts.values())
+
+    if not info["invalid"]:
+        await buffer.add(f"✅ Tất cả file hợp lệ cho tỉnh `{ma_tinh_filter.upper()}`." if ma_tinh_filter else "✅ Tất cả file đều hợp lệ.")
+    if len(folders) > 1:
+        summary = [f"📊 Tổng kết `{spec.label}`: {info['invalid']}/{info['files']} file không hợp lệ"]
+        summary += [f"   • `{folder}`: {invalid}/{total}" for folder, (total, invalid) in counts.items()]
+        await buffer.add("\n".join(summary))
+    await buffer.flush()
+
+async def checkinvalidfile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+
+    ma_tinh_filter = None
+    rev = None
+
+    # Token "@<sha|nhánh|tag>" (vị trí bất kỳ): kiểm tra tại commit đó thay vì HEAD mới nhất
+    args = []
+    for arg in context.args or []:
+        if arg.startswith("@") and len(arg) > 1:
+            rev = arg[1:].strip()
+        else:
+            args.append(arg)
+    if rev is not None and not re.match(r"^[\w./~^-]+$", rev):
+        await get_outbox().send(context.bot, chat_id, f"❌ Commit `{rev}` không hợp lệ.")
         return
 
-    # 4. Pull repo deploy
-    await context.bot.send_message(chat_id=chat_id, text="[4/6] ⏳ Đang cập nhật repo deploy...")
-    if not prepare_repo(DEPLOY_REPO, DEPLOY_REPO_URL, DEPLOY_REPO_BRANCH):
-        await context.bot.send_message(chat_id=chat_id, text="❌ Lỗi khi cập nhật repo deploy.")
+    spec = parse_folder_spec("0")
+    if args:
+        try:
+            parsed = parse_folder_spec(args[0])
+        except ValueError as e:
+            await get_outbox().send(context.bot, chat_id, f"❌ {e}.")
+            return
+        if parsed is not None:
+            spec = parsed
+            if len(args) > 1:
+                ma_tinh_filter = args[1].strip().lower()
+        else:
+            ma_tinh_filter = args[0].strip().lower()
+
+    # Đã có kết quả kiểm tra trước còn mới -> trả lời ngay, không cần pull và kiểm tra lại
+    state = _precheck_state
+    today_str = datetime.now().strftime("%Y%m%d")
+    fast_path = rev is None and state.is_fresh() and spec.dates == [today_str] and bool(state.folders) and (
+        spec.folder is None or spec.folder in state.folders
+    )
+    if fast_path:
+        province_rules = await run_blocking(get_province_rules)
+        # Luật tỉnh đã đổi (nạp lại nóng) sau lần kiểm tra trước -> kết quả sẵn không còn đúng, chạy job
+        fast_path = state.rules_hash == rules_fingerprint(province_rules)
+    if fast_path:
+        if ma_tinh_filter and ma_tinh_filter not in province_rules:
+            await get_outbox().send(context.bot, chat_id, f"❌ Mã tỉnh `{ma_tinh_filter}` không hợp lệ. Vui lòng kiểm tra lại.")
+            return
+        lines = []
+        for folder in sorted(state.folders):
+            if folder_matches(spec, folder):
+                lines += group_invalid_report(folder, state.invalid_files(folder, ma_tinh_filter))
+        if not lines:
+            lines = [(f"✅ Tất cả file hợp lệ cho tỉnh `{ma_tinh_filter.upper()}`." if ma_tinh_filter else "✅ Tất cả file đều hợp lệ.", None)]
+        updated = datetime.fromtimestamp(state.updated).strftime("%H:%M:%S")
+        header = f"📌 Kết quả kiểm tra sẵn của `{spec.label}` tại commit `{state.sha[:8]}` (cập nhật lúc {updated})"
+        await send_report(context.bot, chat_id, [header] + [line for line, _ in lines], [None] + [row for _, row in lines])
         return
-    await context.bot.send_message(chat_id=chat_id, text="✅ Repo deploy đã được cập nhật.")
+
+    manager = get_job_manager()
+    description = f"kiểm tra {spec.label}" + (f" ({ma_tinh_filter.upper()})" if ma_tinh_filter else "") + (f" @{rev}" if rev else "")
+    job, merged = manager.submit(
+        "check", description, context.bot, chat_id,
+        functools.partial(run_check_job, spec, ma_tinh_filter, rev=rev),
+        key=("check", spec.folder or tuple(spec.dates), ma_tinh_filter, rev),
+    )
+    if merged:
+        await get_outbox().send(
+            context.bot, chat_id,
+            f"🔗 Job #{job.id} đang kiểm tra `{spec.label}`. Bạn sẽ nhận cùng kết quả với job này."
+        )
+        await job.subscribe(chat_id)
+    await asyncio.wait([job.task])
+
+async def run_deploy_job(source_time, deploy_time, commit_msg_today, job):
+    manager = get_job_manager()
+    await job.progress(f"🚀 [Job #{job.id}] Bắt đầu deploy với thời gian `{deploy_time}`...")
+
+    # Repo deploy độc lập với repo nguồn -> cập nhật song song ngay từ đầu, chờ kết quả ở bước 4
+    deploy_repo_ready = asyncio.ensure_future(manager.refresh_repo(DEPLOY_REPO, DEPLOY_REPO_URL, DEPLOY_REPO_BRANCH))
+    try:
+        # 1. Pull repo nguồn
+        await job.progress("[1/6] ⏳ Đang cập nhật repo nguồn...")
+        with METRICS.timer("deploy.pull_source", job=job.id):
+            refreshed = await manager.refresh_repo(REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH)
+        if not refreshed:
+            await job.notify("❌ Lỗi khi cập nhật repo nguồn.")
+            return
+        await job.progress("✅ Repo nguồn đã được cập nhật.")
+
+        # latest_folder = get_today_date_folder(REPO_PATH)
+        # if not latest_folder:
+        #     await job.notify("❌ Không tìm thấy thư mục ngày hôm nay trong repo nguồn.")
+        #     return
+
+        today_str = datetime.now().strftime("%Y%m%d")
+        if source_time == '0':
+            latest_folder  = today_str
+        else:
+            latest_folder = f"{today_str}_{source_time}"
+
+        await manager.widen_repo(REPO_PATH, [latest_folder])
+        # Bước 2-3 chỉ đọc repo nguồn: cho phép chạy song song với các job kiểm tra
+        async with manager.repo_lock(REPO_PATH).read():
+            # Kiểm tra xem thư mục nguồn có tồn tại không
+            original_path = os.path.join(REPO_PATH, latest_folder)
+            if not os.path.isdir(original_path):
+                await job.notify(f"❌ Không tìm thấy thư mục nguồn `{latest_folder}` trong repo nguồn.")
+                return
+
+            # 2. Tìm file không hợp lệ
+            await job.progress("[2/6] 🔎 Đang kiểm tra file không hợp lệ...")
+            try:
+                with METRICS.timer("deploy.validate", job=job.id, folder=latest_folder) as info:
+                    province_rules = await run_blocking(get_province_rules)
+                    invalid_files = await run_blocking(collect_invalid_files, REPO_PATH, latest_folder, province_rules)
+                    info["invalid"] = len(invalid_files)
+                await job.progress(f"✅ Tìm thấy {len(invalid_files)} file không hợp lệ.")
+            except Exception as e:
+                await job.notify(f"❌ Lỗi khi kiểm tra file: {e}")
+                return
+
+            # 3. Đồng bộ sang thư mục làm sạch, bỏ luôn file không hợp lệ và jrxml trong lúc copy
+            await job.progress(f"[3/6] 🧹 Đang đồng bộ `{latest_folder}` sang thư mục làm sạch...")
+            cleaned_path = os.path.join(DEST_PATH, latest_folder)
+            excluded = [os.path.relpath(file, latest_folder) for file, _, _, _ in invalid_files]
+            try:
+                with METRICS.timer("deploy.sync_clean", job=job.id) as info:
+                    stats = await run_blocking(sync_folder, original_path, cleaned_path, excluded)
+                    info.update(stats._asdict())
+                await job.progress(f"✅ Đã đồng bộ: {format_sync_stats(stats)}.")
+            except Exception as e:
+                await job.notify(f"❌ Lỗi khi đồng bộ thư mục: {e}")
+                return
+
+        # 4. Pull repo deploy
+        await job.progress("[4/6] ⏳ Đang cập nhật repo deploy...")
+        # Chỉ đo phần thời gian còn phải chờ (repo deploy đã được pull song song từ đầu)
+        with METRICS.timer("deploy.pull_deploy_wait", job=job.id):
+            deploy_ready = await deploy_repo_ready
+        if not deploy_ready:
+            await job.notify("❌ Lỗi khi cập nhật repo deploy.")
+            return
+        await job.progress("✅ Repo deploy đã được cập nhật.")
+    finally:
+        if not deploy_repo_ready.done():
+            # Thoát sớm: vẫn chờ lần pull repo deploy kết thúc trước khi nhả hàng đợi deploy
+            await asyncio.wait([deploy_repo_ready])
 
     # 5. Copy vào các thư mục deploy
-    await context.bot.send_message(chat_id=chat_id, text="[5/6] 🚀 Đang copy code sạch vào thư mục deploy...")
+    await job.progress("[5/6] 🚀 Đang copy code sạch vào thư mục deploy...")
     deploy_folders = [f"BVDAKHOA_{deploy_time}", f"BVLONGAN_{deploy_time}"]
     target_latest_path = os.path.join(DEPLOY_REPO, today_str)
     for folder in deploy_folders:
         try:
             target_deploy_path = os.path.join(target_latest_path, folder)
-            copy_folder(cleaned_path, target_deploy_path)
-            await context.bot.send_message(chat_id=chat_id, text=f"✅ Đã copy vào `{os.path.relpath(target_deploy_path, WORKSPACE)}`")
+            with METRICS.timer("deploy.sync_target", job=job.id, target=folder) as info:
+                stats = await run_blocking(sync_folder, cleaned_path, target_deploy_path, link_mode=DEPLOY_LINK_MODE)
+                info.update(stats._asdict())
+            await job.progress(f"✅ Đã đồng bộ vào `{os.path.relpath(target_deploy_path, WORKSPACE)}` ({format_sync_stats(stats)})")
         except Exception as e:
-            await context.bot.send_message(chat_id=chat_id, text=f"❌ Lỗi khi copy sang {folder}: {e}")
+            await job.notify(f"❌ Lỗi khi copy sang {folder}: {e}")
             return
             
     # 6. Commit & Push
-    await context.bot.send_message(chat_id=chat_id, text="[6/6] ⬆️ Đang commit và push lên Git...")
+    await job.progress("[6/6] ⬆️ Đang commit và push lên Git...")
+    deploy_paths = [os.path.join(today_str, folder) for folder in deploy_folders]
     try:
-        repo = Repo(DEPLOY_REPO)
-        repo.git.add(A=True)
-        repo.index.commit(commit_msg_today)
-        repo.git.push("origin", DEPLOY_REPO_BRANCH)
-        await context.bot.send_message(chat_id=chat_id, text=f"🎉 **DEPLOY THÀNH CÔNG!**\nĐã push lên git với message:\n`{commit_msg_today}`")
+        with METRICS.timer("deploy.commit_push", job=job.id) as info:
+            stats = await run_blocking(commit_and_push, DEPLOY_REPO, commit_msg_today, DEPLOY_REPO_BRANCH, deploy_paths)
+            info.update(stats._asdict() if stats else {"skipped": True})
+        if stats is None:
+            await job.notify("ℹ️ Code deploy không thay đổi so với lần trước, bỏ qua commit và push.")
+            return
+        await job.notify(
+            f"🎉 **DEPLOY THÀNH CÔNG!**\nĐã push lên git với message:\n`{commit_msg_today}`\n"
+            f"📦 {format_commit_stats(stats)}"
+        )
     except Exception as e:
-        await context.bot.send_message(chat_id=chat_id, text=f"❌ Lỗi khi commit/push code:\n{e}")
+        await job.notify(f"❌ Lỗi khi commit/push code:\n{e}")
+
+async def upcode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if len(context.args) < 3:
+        await get_outbox().send(
+            context.bot, chat_id,
+            "❌ Cú pháp sai!\n/upcode <source_time> <deploy_time> <commit_message>\n\n"
+            "Ví dụ:\n"
+            "`/upcode 0 17H19 https://cntt.vnpt.vn/browse/IT360-1551227`\n"
+            "`/upcode 18H01 18H09 https://cntt.vnpt.vn/browse/IT360-1551227`"
+        )
+        return
+
+    source_time = context.args[0].strip().upper()
+    deploy_time = context.args[1].strip().upper()
+    commit_msg_today = " ".join(context.args[2:]).strip()
+
+    if not re.match(r"^(0|\d{2}H\d{2})$", source_time):
+        await get_outbox().send(context.bot, chat_id, f"❌ Định dạng thời gian nguồn '{source_time}' không hợp lệ. Ví dụ: 0 hoặc 17H19")
+        return
+
+    if not re.match(r"^\d{2}H\d{2}$", deploy_time):
+        await get_outbox().send(context.bot, chat_id, f"❌ Định dạng thời gian deploy '{deploy_time}' không hợp lệ. Ví dụ: 17H19")
+        return
+
+    manager = get_job_manager()
+    queued = manager.deploy_busy(DEPLOY_REPO)
+    job, _ = manager.submit(
+        "deploy", f"upcode {source_time} -> {deploy_time}", context.bot, chat_id,
+        functools.partial(run_deploy_job, source_time, deploy_time, commit_msg_today),
+        deploy_repo=DEPLOY_REPO,
+    )
+    if queued:
+        await get_outbox().send(
+            context.bot, chat_id,
+            f"⏸️ Job #{job.id} đã vào hàng đợi deploy, sẽ chạy sau khi các deploy trước hoàn tất."
+        )
+    await asyncio.wait([job.task])
+
+async def jobs_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    manager = get_job_manager()
+    if not manager.jobs:
+        await get_outbox().send(context.bot, update.effective_chat.id, "📭 Chưa có job nào.")
+        return
+    lines = []
+    for job in reversed(list(manager.jobs.values())):
+        line = job.describe()
+        position = manager.queue_position(job)
+        if position:
+            line += f" – vị trí hàng đợi: {position}"
+        lines.append(line)
+    await get_outbox().send(context.bot, update.effective_chat.id, "📋 Danh sách job:\n" + "\n".join(lines))
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    summary = METRICS.summary()
+    if not summary:
+        await get_outbox().send(context.bot, update.effective_chat.id, "📭 Chưa có số đo nào.")
+        return
+    lines = [f"📊 Thời gian từng stage ({METRICS_WINDOW} lần đo gần nhất):"]
+    for stage, (samples, p50, p95, total) in summary.items():
+        lines.append(f"`{stage}`: p50 {format_duration(p50)}, p95 {format_duration(p95)} (n={samples}/{total})")
+    cache = await run_blocking(get_validation_cache)
+    lines.append(f"🗄️ Cache validate: {cache.stats()}")
+    lines.append(f"📐 Luật tỉnh: {get_rules_store().describe()}")
+    await get_outbox().send(context.bot, update.effective_chat.id, "\n".join(lines))
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if not context.args or not context.args[0].lstrip("#").isdigit():
+        await get_outbox().send(context.bot, chat_id, "❌ Cú pháp: /cancel <job_id>. Xem danh sách bằng /jobs")
+        return
+    job_id = int(context.args[0].lstrip("#"))
+    job = get_job_manager().cancel(job_id)
+    if job is None:
+        await get_outbox().send(context.bot, chat_id, f"❌ Không có job #{job_id} đang chạy hoặc đang chờ.")
+        return
+    await get_outbox().send(
+        context.bot, chat_id,
+        f"🛑 Đã yêu cầu hủy job #{job_id}. Bước đang chạy (nếu có) sẽ kết thúc trước khi job dừng."
+    )
 
 # ===================================
 # === MAIN EXECUTION ================
@@ -343,15 +2635,16 @@ if __name__ == "__main__":
     print("=== KHỞI ĐỘNG BOT DEPLOY TỰ ĐỘNG ===")
     print("=============================================")
     
-    # Bước 1: Chuẩn bị repo nguồn
-    if not prepare_repo(REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH):
-        print(" >> Dừng chương trình do không thể chuẩn bị repo nguồn.")
-        exit(1)
-
-    # Bước 2: Chuẩn bị repo deploy
-    if not prepare_repo(DEPLOY_REPO, DEPLOY_REPO_URL, DEPLOY_REPO_BRANCH):
-        print(" >> Dừng chương trình do không thể chuẩn bị repo deploy.")
-        exit(1)
+    # Bước 1 & 2: Chuẩn bị repo nguồn và repo deploy (song song, hai repo độc lập)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        source_ready = pool.submit(prepare_repo, REPO_PATH, SOURCE_REPO_URL, SOURCE_REPO_BRANCH)
+        deploy_ready = pool.submit(prepare_repo, DEPLOY_REPO, DEPLOY_REPO_URL, DEPLOY_REPO_BRANCH)
+        if not source_ready.result():
+            print(" >> Dừng chương trình do không thể chuẩn bị repo nguồn.")
+            exit(1)
+        if not deploy_ready.result():
+            print(" >> Dừng chương trình do không thể chuẩn bị repo deploy.")
+            exit(1)
         
     # Bước 3: Khởi động bot
     print("\n--- Tất cả kho git đã sẵn sàng. Khởi động bot... ---")
@@ -359,10 +2652,25 @@ if __name__ == "__main__":
         print("❌ Lỗi: BOT_TOKEN chưa được cấu hình. Vui lòng sửa lại trong script.")
         exit(1)
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # Nạp luật tỉnh một lần lúc khởi động (in cảnh báo gộp luật nếu có)
+    get_province_rules()
+    warm_validation_pool()
+
+    # concurrent_updates: xử lý nhiều lệnh cùng lúc thay vì lần lượt từng update
+    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(True).build()
 
     app.add_handler(CommandHandler("checkinvalidfile", checkinvalidfile_command))
     app.add_handler(CommandHandler("upcode", upcode_command))
+    app.add_handler(CommandHandler("jobs", jobs_command))
+    app.add_handler(CommandHandler("cancel", cancel_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+
+    if PRECHECK_INTERVAL > 0:
+        if app.job_queue is None:
+            print("⚠️ Không bật được kiểm tra trước: cần cài `python-telegram-bot[job-queue]`.")
+        else:
+            app.job_queue.run_repeating(precheck_poll, interval=PRECHECK_INTERVAL, first=1, name="precheck")
+            print(f"🔁 Kiểm tra trước chạy nền mỗi {PRECHECK_INTERVAL} giây.")
     
     print("🤖 Bot đang chạy... Nhấn CTRL+C để dừng.")
     app.run_polling()
\ No newline at end of file
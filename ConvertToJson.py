@@ -1,3 +1,4 @@
+import argparse
 import os
 import json
 import re
@@ -53,29 +54,70 @@ raw_data = """
 47	CBG	CBG, 30900, 29050
 """
 
-result = []
-lines = raw_data.strip().splitlines()
-for line in lines:
-    parts = re.split(r'\t+', line.strip())
-    stt = int(parts[0]) if parts[0].isdigit() else None
-    ma_tinh = parts[1].strip() if len(parts) > 1 else ""
-    if len(parts) > 2:
-        rest = parts[2].strip().strip('"')
-        duoi_file = [item.strip() for item in re.split(r'[;,]', rest) if item.strip()]
-    else:
-        duoi_file = []
-    result.append({
-        "stt": stt,
-        "ma_tinh": ma_tinh,
-        "duoi_file": duoi_file
-    })
+def parse_raw_data(text):
+    """Chuyển dữ liệu thô (STT <tab> mã tỉnh <tab> mã đơn vị ngăn cách bởi , hoặc ;) thành danh sách tỉnh."""
+    result = []
+    for line in text.strip().splitlines():
+        if not line.strip():
+            continue
+        parts = re.split(r'\t+', line.strip())
+        stt = int(parts[0]) if parts[0].isdigit() else None
+        ma_tinh = parts[1].strip() if len(parts) > 1 else ""
+        if len(parts) > 2:
+            rest = parts[2].strip().strip('"')
+            duoi_file = [item.strip() for item in re.split(r'[;,]', rest) if item.strip()]
+        else:
+            duoi_file = []
+        result.append({
+            "stt": stt,
+            "ma_tinh": ma_tinh,
+            "duoi_file": duoi_file
+        })
+    return result
 
-# Lấy đường dẫn thư mục chứa file .py
-current_dir = os.path.dirname(os.path.abspath(__file__))
-output_path = os.path.join(current_dir, "ProvinceRules.json")
+def write_atomic(path, data):
+    """Ghi ra file tạm rồi đổi tên, để bot đang chạy không bao giờ đọc phải file ghi dở."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
-# Ghi file JSON
-with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(result, f, indent=2, ensure_ascii=False)
+def compile_rules(json_path, artifact_path):
+    """Biên dịch ProvinceRules.json thành artifact JSON gọn mà bot nạp thẳng lúc khởi động."""
+    # Import muộn: chỉ bước biên dịch mới cần dùng chung code dựng regex với bot
+    import CheckInvalidFile as bot
+    with open(json_path, "rb") as f:
+        artifact = bot.build_rules_artifact(f.read())
+    data = json.dumps(artifact, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    write_atomic(artifact_path, data)
+    for warning in artifact["warnings"]:
+        print(f"⚠️ {warning}")
+    print(f"✅ Đã biên dịch {len(artifact['rules'])} tỉnh (version {artifact['version'][:8]}, {len(data)} byte) tại: {artifact_path}")
 
-print(f"✅ Đã tạo xong file ProvinceRules.json tại: {output_path}")
\ No newline at end of file
+def main():
+    # Lấy đường dẫn thư mục chứa file .py
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Tạo ProvinceRules.json từ dữ liệu thô và biên dịch artifact luật tỉnh")
+    parser.add_argument("--raw", help="File dữ liệu thô (mặc định: raw_data trong script)")
+    parser.add_argument("--json", default=os.path.join(current_dir, "ProvinceRules.json"), help="Đường dẫn ProvinceRules.json")
+    parser.add_argument("--artifact", help="Đường dẫn artifact (mặc định: ProvinceRules.compiled.json cạnh file JSON)")
+    parser.add_argument("--compile", action="store_true", help="Biên dịch artifact sau khi tạo file JSON")
+    parser.add_argument("--compile-only", action="store_true", help="Chỉ biên dịch artifact từ file JSON có sẵn")
+    args = parser.parse_args()
+
+    if not args.compile_only:
+        text = raw_data
+        if args.raw:
+            with open(args.raw, "r", encoding="utf-8") as f:
+                text = f.read()
+        result = parse_raw_data(text)
+        # Ghi file JSON
+        write_atomic(args.json, json.dumps(result, indent=2, ensure_ascii=False).encode("utf-8"))
+        print(f"✅ Đã tạo xong file ProvinceRules.json tại: {args.json}")
+
+    if args.compile or args.compile_only:
+        artifact_path = args.artifact or os.path.splitext(args.json)[0] + ".compiled.json"
+        compile_rules(args.json, artifact_path)
+
+if __name__ == "__main__":
+    main()